@@ -1,9 +1,10 @@
 import { NextResponse } from "next/server";
 import { getOrCreateUser } from "@/lib/db/users";
+import { readJsonBody, UnsupportedEncodingError } from "@/lib/request-body";
 
 export async function POST(req: Request) {
   try {
-    const data = await req.json();
+    const data = await readJsonBody(req);
     const user = await getOrCreateUser(data.user);
 
     return NextResponse.json({
@@ -13,6 +14,12 @@ export async function POST(req: Request) {
     });
   } catch (error) {
     console.error("Inlet error:", error);
+    if (error instanceof UnsupportedEncodingError) {
+      return NextResponse.json(
+        { success: false, error: error.message, error_type: error.name },
+        { status: 415 }
+      );
+    }
     return NextResponse.json(
       {
         success: false,
@@ -0,0 +1,122 @@
+import { NextResponse } from "next/server";
+
+const METRIC_PREFIX = "openwebui_monitor_filter_";
+// 超过该时间未推送的过滤器实例不再导出
+const STALE_AFTER_MS = 5 * 60 * 1000;
+
+interface Sample {
+  name: string;
+  labels: Record<string, string>;
+  value: number;
+}
+
+interface HistogramSample {
+  name: string;
+  labels: Record<string, string>;
+  buckets: number[];
+  counts: number[];
+  count: number;
+  sum: number;
+}
+
+interface MetricsSnapshot {
+  instance: string;
+  counters: Sample[];
+  gauges: Sample[];
+  histograms: HistogramSample[];
+}
+
+// 各过滤器实例最近一次推送的快照（进程内存，重启后由下一次推送恢复）
+const globalForMetrics = globalThis as unknown as {
+  filterMetrics?: Map<string, { receivedAt: number; snapshot: MetricsSnapshot }>;
+};
+const snapshots = (globalForMetrics.filterMetrics ??= new Map());
+
+function formatLabels(labels: Record<string, string>): string {
+  const pairs = Object.entries(labels).map(
+    ([key, value]) =>
+      `${key}="${String(value).replace(/\\/g, "\\\\").replace(/"/g, '\\"').replace(/\n/g, "\\n")}"`
+  );
+  return pairs.length ? `{${pairs.join(",")}}` : "";
+}
+
+function renderPrometheus(): string {
+  const now = Date.now();
+  const families = new Map<string, { type: string; lines: string[] }>();
+  const family = (name: string, type: string) => {
+    if (!families.has(name)) {
+      families.set(name, { type, lines: [] });
+    }
+    return families.get(name)!.lines;
+  };
+
+  for (const [instance, { receivedAt, snapshot }] of snapshots) {
+    if (now - receivedAt > STALE_AFTER_MS) {
+      snapshots.delete(instance);
+      continue;
+    }
+
+    for (const sample of snapshot.counters || []) {
+      const name = METRIC_PREFIX + sample.name;
+      family(name, "counter").push(
+        `${name}${formatLabels({ instance, ...sample.labels })} ${sample.value}`
+      );
+    }
+    for (const sample of snapshot.gauges || []) {
+      const name = METRIC_PREFIX + sample.name;
+      family(name, "gauge").push(
+        `${name}${formatLabels({ instance, ...sample.labels })} ${sample.value}`
+      );
+    }
+    for (const histogram of snapshot.histograms || []) {
+      const name = METRIC_PREFIX + histogram.name;
+      const lines = family(name, "histogram");
+      const labels = { instance, ...histogram.labels };
+      histogram.buckets.forEach((bound, i) => {
+        lines.push(
+          `${name}_bucket${formatLabels({ ...labels, le: String(bound) })} ${histogram.counts[i]}`
+        );
+      });
+      lines.push(
+        `${name}_bucket${formatLabels({ ...labels, le: "+Inf" })} ${histogram.count}`
+      );
+      lines.push(`${name}_sum${formatLabels(labels)} ${histogram.sum}`);
+      lines.push(`${name}_count${formatLabels(labels)} ${histogram.count}`);
+    }
+  }
+
+  const output: string[] = [];
+  for (const [name, { type, lines }] of families) {
+    output.push(`# TYPE ${name} ${type}`, ...lines);
+  }
+  return output.join("\n") + "\n";
+}
+
+// 接收过滤器定期推送的指标快照
+export async function POST(req: Request) {
+  try {
+    const snapshot: MetricsSnapshot = await req.json();
+    if (!snapshot.instance) {
+      return NextResponse.json(
+        { success: false, error: "缺少 instance 字段" },
+        { status: 400 }
+      );
+    }
+
+    snapshots.set(snapshot.instance, { receivedAt: Date.now(), snapshot });
+    return NextResponse.json({ success: true });
+  } catch (error) {
+    console.error("Metrics push error:", error);
+    return NextResponse.json(
+      { success: false, error: "无效的指标数据" },
+      { status: 400 }
+    );
+  }
+}
+
+// 以 Prometheus 文本格式导出所有过滤器实例的指标
+export async function GET() {
+  return new NextResponse(renderPrometheus(), {
+    headers: { "Content-Type": "text/plain; version=0.0.4; charset=utf-8" },
+  });
+}
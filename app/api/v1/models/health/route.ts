@@ -0,0 +1,160 @@
+import { NextResponse } from "next/server";
+
+interface Histogram {
+  buckets: number[];
+  // 最后一项为超出最大分桶的样本数
+  counts: number[];
+  sum: number;
+}
+
+interface ModelHealthSample {
+  model: string;
+  success: number;
+  failure: number;
+  latency: Histogram;
+  tokens_per_sec: Histogram;
+}
+
+interface HealthSnapshot {
+  instance: string;
+  window: number;
+  models: ModelHealthSample[];
+}
+
+// 各过滤器实例最近一次推送的模型健康统计（进程内存，重启后由下一次推送恢复）
+const globalForHealth = globalThis as unknown as {
+  modelHealth?: Map<string, { receivedAt: number; snapshot: HealthSnapshot }>;
+};
+const snapshots = (globalForHealth.modelHealth ??= new Map());
+
+function mergeHistogram(target: Histogram | null, source: Histogram): Histogram | null {
+  if (!source || !Array.isArray(source.counts)) {
+    return target;
+  }
+  if (!target) {
+    return { buckets: [...source.buckets], counts: [...source.counts], sum: source.sum };
+  }
+  // 不同版本过滤器的分桶不一致时无法相加，保留先到的
+  if (target.buckets.join(",") !== source.buckets.join(",")) {
+    return target;
+  }
+  source.counts.forEach((count, i) => (target.counts[i] += count));
+  target.sum += source.sum;
+  return target;
+}
+
+// 在分桶内线性插值求分位数；落在最大分桶之外的样本按最大分桶计
+function quantile(histogram: Histogram | null, q: number): number | null {
+  if (!histogram) {
+    return null;
+  }
+  const total = histogram.counts.reduce((sum, count) => sum + count, 0);
+  if (total === 0) {
+    return null;
+  }
+  const rank = q * total;
+  let seen = 0;
+  for (let i = 0; i < histogram.counts.length; i++) {
+    const count = histogram.counts[i];
+    if (count > 0 && seen + count >= rank) {
+      if (i >= histogram.buckets.length) {
+        return histogram.buckets[histogram.buckets.length - 1];
+      }
+      const lower = i === 0 ? 0 : histogram.buckets[i - 1];
+      const upper = histogram.buckets[i];
+      return lower + ((upper - lower) * (rank - seen)) / count;
+    }
+    seen += count;
+  }
+  return histogram.buckets[histogram.buckets.length - 1];
+}
+
+// 接收过滤器定期推送的模型健康统计
+export async function POST(req: Request) {
+  try {
+    const snapshot: HealthSnapshot = await req.json();
+    if (!snapshot.instance || !Array.isArray(snapshot.models)) {
+      return NextResponse.json(
+        { success: false, error: "无效的数据格式" },
+        { status: 400 }
+      );
+    }
+
+    snapshots.set(snapshot.instance, { receivedAt: Date.now(), snapshot });
+    return NextResponse.json({ success: true });
+  } catch (error) {
+    console.error("Model health push error:", error);
+    return NextResponse.json(
+      { success: false, error: "无效的健康统计数据" },
+      { status: 400 }
+    );
+  }
+}
+
+// 合并所有过滤器实例的统计，返回每个模型的成功率、完成耗时和输出速度分位数
+export async function GET() {
+  const now = Date.now();
+  const merged = new Map<
+    string,
+    {
+      success: number;
+      failure: number;
+      latency: Histogram | null;
+      tps: Histogram | null;
+      instances: number;
+      updatedAt: number;
+    }
+  >();
+  let window = 0;
+
+  for (const [instance, { receivedAt, snapshot }] of snapshots) {
+    // 超过一个统计窗口未推送的实例已不代表当前状态
+    if (now - receivedAt > Math.max(60, snapshot.window || 300) * 1000) {
+      snapshots.delete(instance);
+      continue;
+    }
+    window = Math.max(window, snapshot.window || 0);
+
+    for (const sample of snapshot.models) {
+      const entry = merged.get(sample.model) ?? {
+        success: 0,
+        failure: 0,
+        latency: null,
+        tps: null,
+        instances: 0,
+        updatedAt: 0,
+      };
+      entry.success += sample.success || 0;
+      entry.failure += sample.failure || 0;
+      entry.latency = mergeHistogram(entry.latency, sample.latency);
+      entry.tps = mergeHistogram(entry.tps, sample.tokens_per_sec);
+      entry.instances += 1;
+      entry.updatedAt = Math.max(entry.updatedAt, receivedAt);
+      merged.set(sample.model, entry);
+    }
+  }
+
+  return NextResponse.json({
+    window,
+    models: Array.from(merged, ([model, entry]) => {
+      const requests = entry.success + entry.failure;
+      return {
+        model_id: model,
+        requests,
+        failures: entry.failure,
+        success_rate: requests ? entry.success / requests : null,
+        latency_s: {
+          p50: quantile(entry.latency, 0.5),
+          p90: quantile(entry.latency, 0.9),
+          p99: quantile(entry.latency, 0.99),
+        },
+        tokens_per_sec: {
+          p50: quantile(entry.tps, 0.5),
+          p10: quantile(entry.tps, 0.1),
+        },
+        instances: entry.instances,
+        updated_at: new Date(entry.updatedAt).toISOString(),
+      };
+    }),
+  });
+}
@@ -0,0 +1,54 @@
+import { NextResponse } from "next/server";
+import { query } from "@/lib/db/client";
+
+// 按模型统计过滤器上报的首 token 延迟、解码速度和 token 间隔的分位数
+export async function GET(request: Request) {
+  try {
+    const { searchParams } = new URL(request.url);
+    const days = Math.max(1, Math.min(90, Number(searchParams.get("days")) || 7));
+
+    const result = await query(
+      `SELECT
+         model_name,
+         COUNT(*) AS samples,
+         percentile_cont(0.5) WITHIN GROUP (ORDER BY ttft_ms) AS ttft_p50,
+         percentile_cont(0.9) WITHIN GROUP (ORDER BY ttft_ms) AS ttft_p90,
+         percentile_cont(0.99) WITHIN GROUP (ORDER BY ttft_ms) AS ttft_p99,
+         percentile_cont(0.5) WITHIN GROUP (ORDER BY decode_tps) AS tps_p50,
+         percentile_cont(0.1) WITHIN GROUP (ORDER BY decode_tps) AS tps_p10,
+         percentile_cont(0.5) WITHIN GROUP (ORDER BY itl_ms) AS itl_p50,
+         percentile_cont(0.99) WITHIN GROUP (ORDER BY itl_ms) AS itl_p99
+       FROM user_usage_records
+       WHERE ttft_ms IS NOT NULL
+         AND use_time >= NOW() - make_interval(days => $1)
+       GROUP BY model_name
+       ORDER BY model_name`,
+      [days]
+    );
+
+    const toNumber = (value: any) => (value === null ? null : Number(value));
+
+    return NextResponse.json(
+      result.rows.map((row) => ({
+        model_name: row.model_name,
+        samples: parseInt(row.samples),
+        ttft_ms: {
+          p50: toNumber(row.ttft_p50),
+          p90: toNumber(row.ttft_p90),
+          p99: toNumber(row.ttft_p99),
+        },
+        decode_tps: {
+          p50: toNumber(row.tps_p50),
+          p10: toNumber(row.tps_p10),
+        },
+        itl_ms: {
+          p50: toNumber(row.itl_p50),
+          p99: toNumber(row.itl_p99),
+        },
+      }))
+    );
+  } catch (error) {
+    console.error("获取模型性能统计失败:", error);
+    return NextResponse.json({ error: "获取模型性能统计失败" }, { status: 500 });
+  }
+}
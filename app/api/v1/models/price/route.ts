@@ -1,5 +1,10 @@
 import { NextRequest, NextResponse } from "next/server";
 import { updateModelPrice } from "@/lib/db";
+import {
+  getDefaultPrice,
+  getPriceTable,
+  invalidatePriceTable,
+} from "@/lib/db/prices";
 
 interface PriceUpdate {
   id: string;
@@ -8,6 +13,43 @@ interface PriceUpdate {
   per_msg_price: number;
 }
 
+// 供过滤器缓存所有模型价格：If-None-Match 命中时返回 304，带 since 参数时只返回之后更新的价格
+export async function GET(request: NextRequest) {
+  try {
+    const table = await getPriceTable();
+    if (request.headers.get("if-none-match") === table.etag) {
+      return new NextResponse(null, { status: 304, headers: { ETag: table.etag } });
+    }
+
+    const sinceParam = request.nextUrl.searchParams.get("since");
+    const since = sinceParam ? new Date(sinceParam) : null;
+    const incremental = since !== null && !isNaN(since.getTime());
+
+    const prices = [];
+    for (const price of table.prices.values()) {
+      // 同一毫秒内的更新也一并返回，重复的行由过滤器覆盖
+      if (!incremental || price.updated_at >= since) {
+        prices.push(price);
+      }
+    }
+
+    return NextResponse.json(
+      {
+        prices,
+        default: getDefaultPrice(),
+        full: !incremental,
+        // 过滤器合并增量后的行数与此不一致时（有价格被删除）改为全量拉取
+        count: table.prices.size,
+        updated_at: table.updatedAt,
+      },
+      { headers: { ETag: table.etag } }
+    );
+  } catch (error) {
+    console.error("获取模型价格失败:", error);
+    return NextResponse.json({ error: "获取模型价格失败" }, { status: 500 });
+  }
+}
+
 export async function POST(request: NextRequest) {
   try {
     const data = await request.json();
@@ -90,6 +132,7 @@ export async function POST(request: NextRequest) {
       })
     );
 
+    invalidatePriceTable();
     const successCount = results.filter((r) => r.success).length;
     console.log(`成功更新 ${successCount} 个模型的价格`);
 
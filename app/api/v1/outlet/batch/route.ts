@@ -0,0 +1,78 @@
+import { NextResponse } from "next/server";
+import { parseOutletRequest, recordUsage } from "@/lib/db/usage";
+import { readJsonBody, UnsupportedEncodingError } from "@/lib/request-body";
+
+const MAX_BATCH_SIZE = 500;
+
+interface BatchEvent {
+  id: string;
+  payload: any;
+}
+
+// 批量计费：过滤器的写后队列把多条 outlet 事件合并为一次请求
+export async function POST(req: Request) {
+  try {
+    const data = await readJsonBody(req);
+    const events: BatchEvent[] = data.events;
+
+    if (!Array.isArray(events)) {
+      return NextResponse.json(
+        { success: false, error: "无效的数据格式", error_type: "BAD_REQUEST" },
+        { status: 400 }
+      );
+    }
+    if (events.length > MAX_BATCH_SIZE) {
+      return NextResponse.json(
+        {
+          success: false,
+          error: `单批事件数不能超过 ${MAX_BATCH_SIZE}`,
+          error_type: "BATCH_TOO_LARGE",
+        },
+        { status: 413 }
+      );
+    }
+
+    // 逐条计费，message_id 作为幂等键，重试的事件不会重复扣费
+    const results = [];
+    for (const event of events) {
+      try {
+        const request = parseOutletRequest(event.payload);
+        request.messageId = request.messageId || event.id;
+        const result = await recordUsage(request);
+        results.push({
+          id: event.id,
+          success: true,
+          userId: request.userId,
+          userName: request.userName,
+          modelId: request.modelId,
+          ...result,
+        });
+      } catch (error) {
+        console.error("Outlet batch event error:", event.id, error);
+        results.push({
+          id: event.id,
+          success: false,
+          error: error instanceof Error ? error.message : "处理请求时发生错误",
+        });
+      }
+    }
+
+    return NextResponse.json({ success: true, results });
+  } catch (error) {
+    console.error("Outlet batch error:", error);
+    if (error instanceof UnsupportedEncodingError) {
+      return NextResponse.json(
+        { success: false, error: error.message, error_type: error.name },
+        { status: 415 }
+      );
+    }
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : "处理请求时发生错误",
+        error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
+      },
+      { status: 500 }
+    );
+  }
+}
@@ -1,4 +1,5 @@
 import { pool } from "@/lib/db";
+import { invalidatePriceTable } from "@/lib/db/prices";
 import { NextResponse } from "next/server";
 import { PoolClient } from "pg";
 
@@ -24,6 +25,10 @@ export async function POST(req: Request) {
       await client.query("TRUNCATE TABLE user_usage_records CASCADE");
       await client.query("TRUNCATE TABLE model_prices CASCADE");
       await client.query("TRUNCATE TABLE users CASCADE");
+      // 汇总表随原始记录一起清空，下次读取面板时重新结算
+      await client.query(
+        "TRUNCATE TABLE usage_rollups, usage_rollup_state, usage_rollup_batches"
+      );
 
       // 导入用户数据
       if (data.data.users?.length) {
@@ -70,6 +75,7 @@ export async function POST(req: Request) {
       }
 
       await client.query("COMMIT");
+      invalidatePriceTable();
 
       return NextResponse.json({
         success: true,
@@ -1,25 +1,32 @@
 import { NextResponse } from "next/server";
 import { pool } from "@/lib/db";
+import { settleRollups } from "@/lib/db/rollups";
 
+// 读取按小时预先汇总的使用量，而不是每次扫描全部原始记录
 export async function GET(request: Request) {
   try {
     const { searchParams } = new URL(request.url);
     const startTime = searchParams.get("startTime");
     const endTime = searchParams.get("endTime");
 
+    // 结算已结束的小时（通常无需操作；首次调用时回填历史记录）
+    await settleRollups();
+
     const timeFilter =
-      startTime && endTime ? `WHERE use_time >= $1 AND use_time <= $2` : "";
+      startTime && endTime
+        ? `WHERE bucket_start >= date_trunc('hour', $1::timestamptz) AND bucket_start <= $2`
+        : "";
 
     const params = startTime && endTime ? [startTime, endTime] : [];
 
     const [modelResult, userResult, timeRangeResult] = await Promise.all([
       pool.query(
         `
-        SELECT 
+        SELECT
           model_name,
-          COUNT(*) as total_count,
-          COALESCE(SUM(cost), 0) as total_cost
-        FROM user_usage_records
+          SUM(request_count) as total_count,
+          COALESCE(SUM(total_cost), 0) as total_cost
+        FROM usage_rollups
         ${timeFilter}
         GROUP BY model_name
         ORDER BY total_cost DESC
@@ -28,11 +35,11 @@ export async function GET(request: Request) {
       ),
       pool.query(
         `
-        SELECT 
+        SELECT
           nickname,
-          COUNT(*) as total_count,
-          COALESCE(SUM(cost), 0) as total_cost
-        FROM user_usage_records
+          SUM(request_count) as total_count,
+          COALESCE(SUM(total_cost), 0) as total_cost
+        FROM usage_rollups
         ${timeFilter}
         GROUP BY nickname
         ORDER BY total_cost DESC
@@ -40,10 +47,10 @@ export async function GET(request: Request) {
         params
       ),
       pool.query(`
-        SELECT 
-          MIN(use_time) as min_time,
-          MAX(use_time) as max_time
-        FROM user_usage_records
+        SELECT
+          MIN(bucket_start) as min_time,
+          MAX(bucket_start) + interval '1 hour' - interval '1 millisecond' as max_time
+        FROM usage_rollups
       `),
     ]);
 
@@ -0,0 +1,60 @@
+import { NextResponse } from "next/server";
+import { ingestRollups, RollupRow } from "@/lib/db/rollups";
+import { readJsonBody, UnsupportedEncodingError } from "@/lib/request-body";
+
+const MAX_ROLLUP_ROWS = 5000;
+
+// 接收过滤器按 (小时, 用户, 模型) 累加的增量使用量
+export async function POST(req: Request) {
+  try {
+    const data = await readJsonBody(req);
+    const rows: RollupRow[] = data.rollups;
+
+    if (!data.batch_id || !Array.isArray(rows)) {
+      return NextResponse.json(
+        { success: false, error: "无效的数据格式", error_type: "BAD_REQUEST" },
+        { status: 400 }
+      );
+    }
+    if (rows.length > MAX_ROLLUP_ROWS) {
+      return NextResponse.json(
+        {
+          success: false,
+          error: `单批汇总行数不能超过 ${MAX_ROLLUP_ROWS}`,
+          error_type: "BATCH_TOO_LARGE",
+        },
+        { status: 413 }
+      );
+    }
+
+    const valid = rows.filter(
+      (row) =>
+        Number.isFinite(row.bucket) &&
+        row.user_id &&
+        row.model &&
+        Number.isFinite(row.requests) &&
+        Number.isFinite(row.input_tokens) &&
+        Number.isFinite(row.output_tokens) &&
+        Number.isFinite(row.cost)
+    );
+    const result = await ingestRollups(String(data.batch_id), valid);
+
+    return NextResponse.json({ success: true, ...result });
+  } catch (error) {
+    console.error("Rollup ingest error:", error);
+    if (error instanceof UnsupportedEncodingError) {
+      return NextResponse.json(
+        { success: false, error: error.message, error_type: error.name },
+        { status: 415 }
+      );
+    }
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : "处理请求时发生错误",
+        error_type: error instanceof Error ? error.name : "UNKNOWN_ERROR",
+      },
+      { status: 500 }
+    );
+  }
+}
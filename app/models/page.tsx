@@ -37,6 +37,18 @@ interface Model {
   testStatus?: "success" | "error" | "testing";
 }
 
+// 过滤器根据真实请求被动统计的模型健康状况
+interface ModelHealth {
+  model_id: string;
+  requests: number;
+  failures: number;
+  success_rate: number | null;
+  latency_s: { p50: number | null; p90: number | null; p99: number | null };
+  tokens_per_sec: { p50: number | null; p10: number | null };
+}
+
+const HEALTH_REFRESH_MS = 30000;
+
 export default function ModelsPage() {
   const { t } = useTranslation("common");
   const [models, setModels] = useState<Model[]>([]);
@@ -50,6 +62,8 @@ export default function ModelsPage() {
   const [apiKey, setApiKey] = useState<string | null>(null);
   const [showTestStatus, setShowTestStatus] = useState(false);
   const [isTestComplete, setIsTestComplete] = useState(false);
+  const [health, setHealth] = useState<Record<string, ModelHealth>>({});
+  const [healthWindow, setHealthWindow] = useState(300);
 
   useEffect(() => {
     const fetchModels = async () => {
@@ -100,6 +114,34 @@ export default function ModelsPage() {
     fetchApiKey();
   }, []);
 
+  useEffect(() => {
+    if (!apiKey) return;
+
+    const fetchHealth = async () => {
+      try {
+        const response = await fetch("/api/v1/models/health", {
+          headers: { Authorization: `Bearer ${apiKey}` },
+        });
+        if (!response.ok) return;
+        const data = await response.json();
+        setHealth(
+          Object.fromEntries(
+            (data.models as ModelHealth[]).map((item) => [item.model_id, item])
+          )
+        );
+        if (data.window) {
+          setHealthWindow(data.window);
+        }
+      } catch (error) {
+        console.error("获取模型健康状况失败:", error);
+      }
+    };
+
+    fetchHealth();
+    const timer = setInterval(fetchHealth, HEALTH_REFRESH_MS);
+    return () => clearInterval(timer);
+  }, [apiKey]);
+
   const handlePriceUpdate = async (
     id: string,
     field: "input_price" | "output_price" | "per_msg_price",
@@ -229,6 +271,38 @@ export default function ModelsPage() {
     );
   };
 
+  const renderHealthCell = (record: Model) => {
+    const item = health[record.id];
+    if (!item || !item.requests) {
+      return (
+        <span className="text-xs text-gray-400">{t("models.table.noTraffic")}</span>
+      );
+    }
+
+    const rate = item.success_rate ?? 0;
+    const color =
+      rate >= 0.98 ? "bg-green-500" : rate >= 0.9 ? "bg-amber-500" : "bg-red-500";
+    const seconds = (value: number | null) =>
+      value === null ? "-" : `${value.toFixed(1)}s`;
+
+    return (
+      <div className="text-xs leading-5">
+        <div className="flex items-center gap-1.5 font-medium">
+          <span className={`inline-block w-2 h-2 rounded-full ${color}`} />
+          {(rate * 100).toFixed(rate === 1 ? 0 : 1)}%
+          <span className="text-gray-400 font-normal">
+            · {t("models.table.requests", { count: item.requests })}
+          </span>
+        </div>
+        <div className="text-gray-500">
+          p50 {seconds(item.latency_s.p50)} / p90 {seconds(item.latency_s.p90)}
+          {item.tokens_per_sec.p50 !== null &&
+            ` · ${item.tokens_per_sec.p50.toFixed(0)} T/s`}
+        </div>
+      </div>
+    );
+  };
+
   const handleTestSingleModel = async (model: Model) => {
     try {
       setModels((prev) =>
@@ -336,6 +410,26 @@ export default function ModelsPage() {
       sortDirections: ["descend", "ascend", "descend"],
       render: (_, record) => renderPriceCell("per_msg_price", record),
     },
+    {
+      title: (
+        <span>
+          {t("models.table.health")}{" "}
+          <Tooltip
+            title={t("models.table.healthTooltip", {
+              minutes: Math.round(healthWindow / 60),
+            })}
+          >
+            <InfoCircleOutlined className="text-gray-400 cursor-help" />
+          </Tooltip>
+        </span>
+      ),
+      key: "health",
+      width: 190,
+      sorter: (a, b) =>
+        (health[a.id]?.success_rate ?? -1) - (health[b.id]?.success_rate ?? -1),
+      sortDirections: ["descend", "ascend", "descend"],
+      render: (_, record) => renderHealthCell(record),
+    },
   ];
 
   const handleExportPrices = () => {
@@ -579,6 +673,13 @@ export default function ModelsPage() {
             </div>
           </div>
         </div>
+
+        <div className="mt-3 flex items-center justify-between border-t pt-3">
+          <span className="text-xs text-muted-foreground">
+            {t("models.table.health")}
+          </span>
+          {renderHealthCell(record)}
+        </div>
       </div>
     );
   };
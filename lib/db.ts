@@ -127,6 +127,56 @@ export async function ensureTablesExist() {
         FOREIGN KEY (user_id) REFERENCES users(id)
       );
     `);
+
+    // 为 user_usage_records 添加 message_id 幂等键（过滤器重试时避免重复计费）
+    await client.query(`
+      ALTER TABLE user_usage_records
+        ADD COLUMN IF NOT EXISTS message_id TEXT;
+    `);
+    await client.query(`
+      CREATE UNIQUE INDEX IF NOT EXISTS user_usage_records_message_id_idx
+        ON user_usage_records (message_id);
+    `);
+
+    // 过滤器上报的流式计时：首 token 延迟、解码速度、平均 token 间隔
+    await client.query(`
+      ALTER TABLE user_usage_records
+        ADD COLUMN IF NOT EXISTS ttft_ms DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS decode_tps DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS itl_ms DOUBLE PRECISION;
+    `);
+
+    // 按小时、用户、模型预先汇总的使用量，面板读取它而不是扫描原始记录
+    await client.query(`
+      CREATE INDEX IF NOT EXISTS user_usage_records_use_time_idx
+        ON user_usage_records (use_time);
+    `);
+    await client.query(`
+      CREATE TABLE IF NOT EXISTS usage_rollups (
+        bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        user_id TEXT NOT NULL,
+        nickname VARCHAR(255) NOT NULL,
+        model_name VARCHAR(255) NOT NULL,
+        request_count BIGINT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        total_cost DECIMAL(16, 6) NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket_start, user_id, model_name)
+      );
+    `);
+    // 早于 settled_until 的小时已从原始记录结算，不再接受过滤器的增量
+    await client.query(`
+      CREATE TABLE IF NOT EXISTS usage_rollup_state (
+        id INTEGER PRIMARY KEY,
+        settled_until TIMESTAMP WITH TIME ZONE NOT NULL
+      );
+    `);
+    await client.query(`
+      CREATE TABLE IF NOT EXISTS usage_rollup_batches (
+        batch_id TEXT PRIMARY KEY,
+        received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+      );
+    `);
   } catch (error) {
     console.error("Database connection/initialization error:", error);
     throw error;
@@ -0,0 +1,130 @@
+import { query } from "./client";
+
+export interface ModelPrice {
+  id: string;
+  name: string;
+  input_price: number;
+  output_price: number;
+  per_msg_price: number;
+}
+
+interface PriceTable {
+  loadedAt: number;
+  prices: Map<string, ModelPrice & { updated_at: Date }>;
+  // 价格表版本：行数、最后更新时间和默认价格共同决定，任何一项变化都会改变 ETag
+  etag: string;
+  updatedAt: Date | null;
+}
+
+// 多实例部署时其他实例修改的价格最多延迟这么久生效；本实例修改时立即失效
+const PRICE_CACHE_TTL_MS = 30 * 1000;
+
+let priceTable: PriceTable | null = null;
+let loading: Promise<PriceTable> | null = null;
+
+// 默认价格（未在数据库中配置的模型），无效时返回 null
+export function getDefaultPrice(): Omit<ModelPrice, "id" | "name"> | null {
+  const inputPrice = parseFloat(process.env.DEFAULT_MODEL_INPUT_PRICE || "60");
+  const outputPrice = parseFloat(
+    process.env.DEFAULT_MODEL_OUTPUT_PRICE || "60"
+  );
+
+  // 验证默认价格是否为有效的非负数
+  if (
+    isNaN(inputPrice) ||
+    inputPrice < 0 ||
+    isNaN(outputPrice) ||
+    outputPrice < 0
+  ) {
+    return null;
+  }
+
+  return {
+    input_price: inputPrice,
+    output_price: outputPrice,
+    per_msg_price: -1, // 默认使用按 token 计费
+  };
+}
+
+async function loadPriceTable(): Promise<PriceTable> {
+  const result = await query(
+    `SELECT id, name, input_price, output_price, per_msg_price, updated_at
+     FROM model_prices`
+  );
+
+  const prices = new Map<string, ModelPrice & { updated_at: Date }>();
+  let updatedAt: Date | null = null;
+  for (const row of result.rows) {
+    const rowUpdatedAt = new Date(row.updated_at);
+    prices.set(row.id, {
+      id: row.id,
+      name: row.name,
+      input_price: Number(row.input_price),
+      output_price: Number(row.output_price),
+      per_msg_price: Number(row.per_msg_price ?? -1),
+      updated_at: rowUpdatedAt,
+    });
+    if (!updatedAt || rowUpdatedAt > updatedAt) {
+      updatedAt = rowUpdatedAt;
+    }
+  }
+
+  const defaults = getDefaultPrice();
+  const etag = `W/"${prices.size}-${updatedAt ? updatedAt.getTime() : 0}-${
+    defaults ? `${defaults.input_price}-${defaults.output_price}` : "none"
+  }"`;
+
+  return { loadedAt: Date.now(), prices, etag, updatedAt };
+}
+
+// 获取进程内缓存的价格表，过期后重新加载（并发请求共用同一次查询）
+export async function getPriceTable(): Promise<PriceTable> {
+  if (priceTable && Date.now() - priceTable.loadedAt < PRICE_CACHE_TTL_MS) {
+    return priceTable;
+  }
+  if (!loading) {
+    loading = loadPriceTable()
+      .then((table) => {
+        priceTable = table;
+        return table;
+      })
+      .finally(() => {
+        loading = null;
+      });
+  }
+  return loading;
+}
+
+// 价格被修改后调用，下次读取时重新加载
+export function invalidatePriceTable() {
+  priceTable = null;
+}
+
+export async function getModelPrice(
+  modelId: string
+): Promise<ModelPrice | null> {
+  const table = await getPriceTable();
+  const price = table.prices.get(modelId);
+  if (price) {
+    return price;
+  }
+
+  // 如果数据库中没有找到价格，使用默认价格
+  const defaults = getDefaultPrice();
+  return defaults ? { id: modelId, name: modelId, ...defaults } : null;
+}
+
+export function calculateCost(
+  price: ModelPrice,
+  inputTokens: number,
+  outputTokens: number
+): number {
+  if (price.per_msg_price >= 0) {
+    // 如果设置了每条消息的固定价格，直接使用
+    return Number(price.per_msg_price);
+  }
+  // 否则按 token 数量计算价格
+  const inputCost = (inputTokens / 1_000_000) * price.input_price;
+  const outputCost = (outputTokens / 1_000_000) * price.output_price;
+  return inputCost + outputCost;
+}
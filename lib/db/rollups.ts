@@ -0,0 +1,179 @@
+import { PoolClient } from "pg";
+import { pool } from "@/lib/db";
+
+// 汇总表的时间粒度固定为 1 小时，与面板时间范围选择的粒度一致
+export const ROLLUP_BUCKET_SECONDS = 3600;
+// 当前小时结束后再等待一段时间才结算，等待进行中的计费事务提交
+const SETTLE_DELAY = "5 minutes";
+// 结算与写入增量之间互斥的 advisory lock
+const ROLLUP_LOCK_ID = 727001;
+
+export interface RollupRow {
+  bucket: number;
+  user_id: string;
+  nickname: string | null;
+  model: string;
+  requests: number;
+  input_tokens: number;
+  output_tokens: number;
+  cost: number;
+}
+
+let settling: Promise<void> | null = null;
+
+// 把已结束的小时从原始记录重新汇总一次，覆盖过滤器上报的增量。
+// 过滤器的增量只负责尚未结算的最近几小时，丢失或迟到的上报在结算后自动修正；
+// 第一次结算会回填全部历史记录。
+export function settleRollups(): Promise<void> {
+  if (!settling) {
+    settling = doSettle().finally(() => {
+      settling = null;
+    });
+  }
+  return settling;
+}
+
+async function doSettle() {
+  let client: PoolClient | null = null;
+  try {
+    client = await pool.connect();
+    await client.query("BEGIN");
+
+    // 其他实例正在结算时直接跳过
+    const lock = await client.query(
+      "SELECT pg_try_advisory_xact_lock($1) AS locked",
+      [ROLLUP_LOCK_ID]
+    );
+    if (!lock.rows[0].locked) {
+      await client.query("ROLLBACK");
+      return;
+    }
+
+    const state = await client.query(
+      `SELECT
+         (SELECT settled_until FROM usage_rollup_state WHERE id = 1) AS settled_until,
+         date_trunc('hour', NOW() - interval '${SETTLE_DELAY}') AS target`
+    );
+    const { settled_until: settledUntil, target } = state.rows[0];
+    if (settledUntil && settledUntil >= target) {
+      await client.query("COMMIT");
+      return;
+    }
+
+    await client.query(
+      `DELETE FROM usage_rollups
+       WHERE bucket_start < $1
+         AND ($2::timestamptz IS NULL OR bucket_start >= $2)`,
+      [target, settledUntil]
+    );
+    await client.query(
+      `INSERT INTO usage_rollups (
+         bucket_start, user_id, nickname, model_name,
+         request_count, input_tokens, output_tokens, total_cost
+       )
+       SELECT
+         date_trunc('hour', use_time), user_id, MAX(nickname), model_name,
+         COUNT(*), SUM(input_tokens), SUM(output_tokens), SUM(cost)
+       FROM user_usage_records
+       WHERE use_time < $1
+         AND ($2::timestamptz IS NULL OR use_time >= $2)
+       GROUP BY date_trunc('hour', use_time), user_id, model_name`,
+      [target, settledUntil]
+    );
+    await client.query(
+      `INSERT INTO usage_rollup_state (id, settled_until) VALUES (1, $1)
+       ON CONFLICT (id) DO UPDATE SET settled_until = EXCLUDED.settled_until`,
+      [target]
+    );
+    await client.query(
+      `DELETE FROM usage_rollup_batches WHERE received_at < NOW() - interval '1 day'`
+    );
+
+    await client.query("COMMIT");
+  } catch (error) {
+    if (client) {
+      await client.query("ROLLBACK");
+    }
+    console.error("结算使用量汇总失败:", error);
+    throw error;
+  } finally {
+    if (client) {
+      client.release();
+    }
+  }
+}
+
+// 写入过滤器上报的一批增量；同一批次 ID 只累加一次，已结算小时的增量被忽略
+export async function ingestRollups(
+  batchId: string,
+  rows: RollupRow[]
+): Promise<{ duplicate: boolean; applied: number }> {
+  let client: PoolClient | null = null;
+  try {
+    client = await pool.connect();
+    await client.query("BEGIN");
+    await client.query("SELECT pg_advisory_xact_lock_shared($1)", [
+      ROLLUP_LOCK_ID,
+    ]);
+
+    const batch = await client.query(
+      `INSERT INTO usage_rollup_batches (batch_id) VALUES ($1)
+       ON CONFLICT (batch_id) DO NOTHING
+       RETURNING batch_id`,
+      [batchId]
+    );
+    if (batch.rows.length === 0) {
+      await client.query("COMMIT");
+      return { duplicate: true, applied: 0 };
+    }
+
+    const result = await client.query(
+      `INSERT INTO usage_rollups (
+         bucket_start, user_id, nickname, model_name,
+         request_count, input_tokens, output_tokens, total_cost
+       )
+       SELECT
+         date_trunc('hour', to_timestamp(r.bucket)), r.user_id,
+         COALESCE(r.nickname, 'Unknown User'), r.model_name,
+         SUM(r.requests), SUM(r.input_tokens), SUM(r.output_tokens), SUM(r.cost)
+       FROM unnest(
+         $1::bigint[], $2::text[], $3::text[], $4::text[],
+         $5::bigint[], $6::bigint[], $7::bigint[], $8::numeric[]
+       ) AS r(bucket, user_id, nickname, model_name, requests, input_tokens, output_tokens, cost)
+       WHERE to_timestamp(r.bucket) >= COALESCE(
+         (SELECT settled_until FROM usage_rollup_state WHERE id = 1),
+         '-infinity'::timestamptz
+       )
+       GROUP BY date_trunc('hour', to_timestamp(r.bucket)), r.user_id,
+         COALESCE(r.nickname, 'Unknown User'), r.model_name
+       ON CONFLICT (bucket_start, user_id, model_name) DO UPDATE SET
+         nickname = EXCLUDED.nickname,
+         request_count = usage_rollups.request_count + EXCLUDED.request_count,
+         input_tokens = usage_rollups.input_tokens + EXCLUDED.input_tokens,
+         output_tokens = usage_rollups.output_tokens + EXCLUDED.output_tokens,
+         total_cost = usage_rollups.total_cost + EXCLUDED.total_cost`,
+      [
+        rows.map((row) => row.bucket),
+        rows.map((row) => row.user_id),
+        rows.map((row) => row.nickname),
+        rows.map((row) => row.model),
+        rows.map((row) => row.requests),
+        rows.map((row) => row.input_tokens),
+        rows.map((row) => row.output_tokens),
+        rows.map((row) => row.cost),
+      ]
+    );
+
+    await client.query("COMMIT");
+    return { duplicate: false, applied: result.rowCount ?? 0 };
+  } catch (error) {
+    if (client) {
+      await client.query("ROLLBACK");
+    }
+    throw error;
+  } finally {
+    if (client) {
+      client.release();
+    }
+  }
+}
@@ -0,0 +1,223 @@
+import { encode } from "gpt-tokenizer/model/gpt-4";
+import { LRUCache } from "lru-cache";
+import { query } from "./client";
+import { calculateCost, getModelPrice } from "./prices";
+
+interface Message {
+  role: string;
+  content: string;
+  info?: {
+    prompt_tokens?: number;
+    completion_tokens?: number;
+  };
+}
+
+export interface OutletMessage {
+  role?: string;
+  hash?: string;
+  content?: string;
+  tokens?: number;
+}
+
+// 过滤器 stream 钩子测得的计时（毫秒）
+export interface OutletTiming {
+  ttft_ms: number;
+  decode_ms: number;
+  chunks: number;
+}
+
+export interface OutletUsage {
+  prompt_tokens: number;
+  completion_tokens: number;
+}
+
+// 统一后的 outlet 请求，兼容旧版（完整 body）和新版（精简）两种格式
+export interface OutletRequest {
+  modelId: string;
+  userId: string;
+  userName: string;
+  usage: OutletUsage | null;
+  messages: OutletMessage[];
+  // 幂等键（assistant 消息 ID），同一条消息只计费一次
+  messageId: string | null;
+  timing: OutletTiming | null;
+  // 过滤器按本地缓存的价格算出的费用，服务端校验后使用
+  cost: number | null;
+}
+
+export interface UsageResult {
+  inputTokens: number;
+  outputTokens: number;
+  totalCost: number;
+  newBalance: number;
+  duplicate: boolean;
+}
+
+// 按内容哈希缓存 token 数，避免每轮对话重复编码历史消息
+const tokenCountCache = new LRUCache<string, number>({ max: 50000 });
+
+export function parseOutletRequest(data: any): OutletRequest {
+  if (data.version === 2) {
+    return {
+      modelId: data.model,
+      userId: data.user.id,
+      userName: data.user.name || "Unknown User",
+      usage: data.usage || null,
+      messages: data.messages || [],
+      messageId: data.message_id || null,
+      timing: data.timing || null,
+      cost: typeof data.cost === "number" ? data.cost : null,
+    };
+  }
+
+  const messages: Message[] = data.body.messages;
+  const lastMessage = messages[messages.length - 1];
+  const usage =
+    lastMessage.info &&
+    lastMessage.info.prompt_tokens &&
+    lastMessage.info.completion_tokens
+      ? {
+          prompt_tokens: lastMessage.info.prompt_tokens,
+          completion_tokens: lastMessage.info.completion_tokens,
+        }
+      : null;
+
+  return {
+    modelId: data.body.model,
+    userId: data.user.id,
+    userName: data.user.name || "Unknown User",
+    usage,
+    messages: messages.map((msg) => ({ role: msg.role, content: msg.content })),
+    // 旧版过滤器上报完整 body，其中的 id 即 assistant 消息 ID
+    messageId: data.body.id || null,
+    timing: null,
+    cost: null,
+  };
+}
+
+function countTokens(message: OutletMessage): number {
+  // 过滤器已在本地计算好 token 数
+  if (typeof message.tokens === "number") {
+    return message.tokens;
+  }
+
+  if (message.hash) {
+    const cached = tokenCountCache.get(message.hash);
+    if (cached !== undefined) {
+      return cached;
+    }
+  }
+
+  const count = encode(message.content || "").length;
+  if (message.hash) {
+    tokenCountCache.set(message.hash, count);
+  }
+  return count;
+}
+
+// 计算一次对话的费用并扣减余额、写入使用记录
+export async function recordUsage(request: OutletRequest): Promise<UsageResult> {
+  const { modelId, userId, userName, usage, messages, messageId, timing, cost } =
+    request;
+
+  // 获取模型价格（进程内缓存，不再每条消息查询一次数据库）
+  const modelPrice = await getModelPrice(modelId);
+  if (!modelPrice) {
+    throw new Error(`未找到模型 ${modelId} 的价格信息`);
+  }
+
+  // 计算 tokens
+  let inputTokens: number;
+  let outputTokens: number;
+  if (usage) {
+    inputTokens = usage.prompt_tokens;
+    outputTokens = usage.completion_tokens;
+  } else {
+    outputTokens = countTokens(messages[messages.length - 1]);
+    const totalTokens = messages.reduce(
+      (sum: number, msg: OutletMessage) => sum + countTokens(msg),
+      0
+    );
+    inputTokens = totalTokens - outputTokens;
+  }
+
+  // 计算成本；过滤器预先算好的费用与服务端结果不一致时（价格缓存过期）以服务端为准
+  const totalCost = calculateCost(modelPrice, inputTokens, outputTokens);
+  if (cost !== null && Math.abs(cost - totalCost) > 1e-9 + totalCost * 1e-6) {
+    console.warn(
+      `过滤器预估费用与服务端不一致: 模型 ${modelId}，过滤器 ${cost}，服务端 ${totalCost}`
+    );
+  }
+
+  // 首 token 之后的解码速度和平均 token 间隔
+  let decodeTps: number | null = null;
+  let itlMs: number | null = null;
+  if (timing && timing.decode_ms > 0 && outputTokens > 1) {
+    decodeTps = (outputTokens - 1) / (timing.decode_ms / 1000);
+  }
+  if (timing && timing.chunks > 1) {
+    itlMs = timing.decode_ms / (timing.chunks - 1);
+  }
+
+  // 记录使用情况并扣减余额；message_id 冲突时两者都不执行
+  const userResult = await query(
+    `WITH inserted AS (
+       INSERT INTO user_usage_records (
+         user_id, nickname, model_name,
+         input_tokens, output_tokens,
+         cost, balance_after, message_id,
+         ttft_ms, decode_tps, itl_ms
+       )
+       SELECT $1, $2, $3, $4, $5, $6, balance - $6, $7, $8, $9, $10
+       FROM users WHERE id = $1
+       ON CONFLICT (message_id) DO NOTHING
+       RETURNING id
+     )
+     UPDATE users
+     SET balance = balance - $6
+     WHERE id = $1 AND EXISTS (SELECT 1 FROM inserted)
+     RETURNING balance`,
+    [
+      userId,
+      userName,
+      modelId,
+      inputTokens,
+      outputTokens,
+      totalCost,
+      messageId,
+      timing ? timing.ttft_ms : null,
+      decodeTps,
+      itlMs,
+    ]
+  );
+
+  if (userResult.rows.length === 0) {
+    if (messageId) {
+      const existing = await query(
+        `SELECT r.input_tokens, r.output_tokens, r.cost, u.balance
+         FROM user_usage_records r
+         JOIN users u ON u.id = r.user_id
+         WHERE r.message_id = $1`,
+        [messageId]
+      );
+      if (existing.rows[0]) {
+        return {
+          inputTokens: existing.rows[0].input_tokens,
+          outputTokens: existing.rows[0].output_tokens,
+          totalCost: Number(existing.rows[0].cost),
+          newBalance: Number(existing.rows[0].balance),
+          duplicate: true,
+        };
+      }
+    }
+    throw new Error("用户不存在");
+  }
+
+  return {
+    inputTokens,
+    outputTokens,
+    totalCost,
+    newBalance: Number(userResult.rows[0].balance),
+    duplicate: false,
+  };
+}
@@ -0,0 +1,45 @@
+import { promisify } from "util";
+import * as zlib from "zlib";
+
+// 解压后的请求体上限，防止压缩炸弹
+const MAX_BODY_BYTES = 64 * 1024 * 1024;
+
+type Decompressor = (buffer: Buffer, options: zlib.ZlibOptions) => Promise<Buffer>;
+
+const decompressors: Record<string, Decompressor> = {
+  gzip: promisify(zlib.gunzip),
+  deflate: promisify(zlib.inflate),
+  br: promisify(zlib.brotliDecompress) as Decompressor,
+};
+
+// Node.js 22.15+ 才内置 zstd
+const zstdDecompress = (zlib as any).zstdDecompress;
+if (typeof zstdDecompress === "function") {
+  decompressors.zstd = promisify(zstdDecompress);
+}
+
+export class UnsupportedEncodingError extends Error {
+  constructor(encoding: string) {
+    super(`不支持的 Content-Encoding: ${encoding}`);
+    this.name = "UNSUPPORTED_ENCODING";
+  }
+}
+
+// 读取 JSON 请求体，支持过滤器发送的 gzip/zstd 等压缩格式
+export async function readJsonBody(req: Request): Promise<any> {
+  const encoding = (req.headers.get("content-encoding") || "identity")
+    .trim()
+    .toLowerCase();
+  if (encoding === "identity") {
+    return req.json();
+  }
+
+  const decompress = decompressors[encoding];
+  if (!decompress) {
+    throw new UnsupportedEncodingError(encoding);
+  }
+
+  const buffer = Buffer.from(await req.arrayBuffer());
+  const body = await decompress(buffer, { maxOutputLength: MAX_BODY_BYTES });
+  return JSON.parse(body.toString("utf-8"));
+}
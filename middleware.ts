@@ -7,11 +7,14 @@ const ACCESS_TOKEN = process.env.ACCESS_TOKEN;
 export async function middleware(request: NextRequest) {
   const { pathname } = request.nextUrl;
 
-  // 只验证 inlet/outlet/test API 请求
+  // 只验证 inlet/outlet/rollups/test/metrics/health API 请求
   if (
     pathname.startsWith("/api/v1/inlet") ||
     pathname.startsWith("/api/v1/outlet") ||
-    pathname.startsWith("/api/v1/models/test")
+    pathname.startsWith("/api/v1/metrics") ||
+    pathname.startsWith("/api/v1/rollups") ||
+    pathname.startsWith("/api/v1/models/test") ||
+    pathname.startsWith("/api/v1/models/health")
   ) {
     // API 请求验证
     if (!API_KEY) {
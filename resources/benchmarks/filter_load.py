@@ -0,0 +1,469 @@
+"""OpenWebUI 函数的基准与压测：在本地模拟的监控服务上驱动 Filter.inlet/stream/outlet 和 Action.action
+
+报告每种过滤器、对话长度和并发度下的吞吐、各阶段 p50/p99 延迟、内存分配和事件循环阻塞时间。
+
+用法:
+    python resources/benchmarks/filter_load.py
+    python resources/benchmarks/filter_load.py --messages 10,200 --concurrency 1,32 --turns 400
+    python resources/benchmarks/filter_load.py --json results.json
+    python resources/benchmarks/filter_load.py --baseline results.json --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(__file__), "..", "functions")
+FILTERS = ("openwebui_monitor", "openwebui_monitor_invisible")
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(FUNCTIONS_DIR, f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StandInMonitor:
+    """最小的 HTTP/1.1 监控服务替身，运行在独立线程的事件循环中，不占用被测过滤器的事件循环"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests: Counter = Counter()
+        self.url = ""
+        self._server = None
+        self._handlers: set = set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, "127.0.0.1", 0), self._loop
+        ).result()
+        self.url = f"http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}"
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            for handler in self._handlers:
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+
+    def _respond(self, path: str, body: bytes) -> tuple:
+        if path == "/api/v1/inlet":
+            return 200, {"success": True, "balance": 1000.0}
+        if path == "/api/v1/outlet":
+            return 200, {
+                "success": True,
+                "inputTokens": 1000,
+                "outputTokens": 200,
+                "totalCost": 0.012,
+                "newBalance": 999.0,
+            }
+        if path == "/api/v1/outlet/batch":
+            events = json.loads(body).get("events", [])
+            return 200, {
+                "success": True,
+                "results": [
+                    {
+                        "id": event["id"],
+                        "success": True,
+                        "userId": event["payload"]["user"]["id"],
+                        "inputTokens": 1000,
+                        "outputTokens": 200,
+                        "totalCost": 0.012,
+                        "newBalance": 999.0,
+                        "duplicate": False,
+                    }
+                    for event in events
+                ],
+            }
+        return 200, {"success": True}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+                request_line, *header_lines = head.split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                encoding = headers.get("content-encoding")
+                if encoding == "gzip":
+                    body = gzip.decompress(body)
+                    status, payload = self._respond(path, body)
+                elif encoding:
+                    status, payload = 415, {"success": False}
+                else:
+                    status, payload = self._respond(path, body)
+
+                self.requests[path] += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                content = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n\r\n".encode("latin-1")
+                    + content
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+
+class LoopLagMonitor:
+    """以固定间隔休眠并测量实际唤醒延迟，估算事件循环被同步代码阻塞的时间"""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.blocked = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            # 低于 1ms 的抖动视为调度噪声
+            if lag > 0.001:
+                self.blocked += lag
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def build_conversation(messages: int, message_chars: int, with_usage: bool) -> list:
+    text = ("OpenWebUI usage monitor benchmark 监控 " * message_chars)[:message_chars]
+    conversation = [
+        {
+            "id": f"m{i}",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": text,
+        }
+        for i in range(max(1, messages - 1))
+    ]
+    if conversation[-1]["role"] == "assistant":
+        conversation.append({"id": "q", "role": "user", "content": text})
+    return conversation
+
+
+class Scenario:
+    def __init__(self, args, filter_name: str, messages: int, concurrency: int, server):
+        self.args = args
+        self.filter_name = filter_name
+        self.messages = messages
+        self.concurrency = concurrency
+        self.workdir = tempfile.mkdtemp(prefix="owm-bench-")
+
+        self.module = load_function(filter_name)
+        self.filter = self.module.Filter()
+        valves = self.filter.valves
+        valves.API_ENDPOINT = server.url
+        valves.API_KEY = "bench"
+        if hasattr(valves, "write_behind"):
+            valves.write_behind = args.write_behind
+            valves.spool_path = os.path.join(self.workdir, "spool.db")
+        if hasattr(valves, "record_db_path"):
+            valves.record_db_path = os.path.join(self.workdir, "usage_records.db")
+        if hasattr(valves, "migrate_legacy_records"):
+            # 迁移会删除导入的 JSON 文件，压测时绝不能碰到主机上真实的旧版记录
+            valves.migrate_legacy_records = False
+            valves.legacy_record_dir = self.workdir
+
+        self.action = None
+        if filter_name == "openwebui_monitor_invisible":
+            self.action = load_function("get_usage_button").Action()
+            self.action.valves.record_db_path = valves.record_db_path
+
+        self.history = build_conversation(
+            messages, args.message_chars, not args.no_usage
+        )
+        self.latencies = {"inlet": [], "outlet": [], "action": []}
+
+    async def turn(self, index: int):
+        """一轮对话：inlet -> 流式输出 -> outlet -> （可选）点击计费按钮"""
+        chat_id = f"chat-{index % self.args.users}"
+        message_id = uuid.uuid4().hex
+        user = {
+            "id": f"user-{index % self.args.users}",
+            "email": "bench@example.com",
+            "name": "Bench",
+            "role": "user",
+        }
+        metadata = {"chat_id": chat_id, "message_id": message_id}
+        body = {"model": "gpt-4o", "chat_id": chat_id, "messages": list(self.history)}
+
+        started = time.perf_counter()
+        await self.filter.inlet(body, __user__=user, __metadata__=metadata)
+        self.latencies["inlet"].append(time.perf_counter() - started)
+
+        chunk = {"choices": [{"delta": {"content": "token "}}]}
+        for _ in range(self.args.chunks):
+            self.filter.stream(chunk, __metadata__=metadata)
+            await asyncio.sleep(0)
+
+        answer = {
+            "id": message_id,
+            "role": "assistant",
+            "content": "token " * self.args.chunks,
+        }
+        if not self.args.no_usage:
+            answer["info"] = {"prompt_tokens": 1000, "completion_tokens": self.args.chunks}
+        outlet_body = {**body, "id": message_id, "messages": body["messages"] + [answer]}
+
+        async def emit(event):
+            pass
+
+        started = time.perf_counter()
+        await self.filter.outlet(
+            outlet_body, __user__=user, __event_emitter__=emit, __metadata__=metadata
+        )
+        self.latencies["outlet"].append(time.perf_counter() - started)
+
+        if self.action is not None:
+            started = time.perf_counter()
+            await self.action.action(outlet_body, __user__=user, __event_emitter__=emit)
+            self.latencies["action"].append(time.perf_counter() - started)
+
+    async def run_turns(self, turns: int, concurrency: int):
+        counter = iter(range(turns))
+
+        async def worker():
+            for index in counter:
+                await self.turn(index)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def measure_allocations(self, turns: int) -> dict:
+        """顺序执行若干轮，记录峰值内存和每轮残留的内存（tracemalloc 开销大，单独测量）"""
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await self.run_turns(turns, 1)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "peak_kib": (peak - baseline) / 1024,
+            "retained_kib_per_turn": (current - baseline) / 1024 / turns,
+        }
+
+    async def close(self):
+        """停止过滤器的后台任务并删除临时目录"""
+        tasks = [
+            task
+            for task in vars(self.filter).values()
+            if isinstance(task, asyncio.Task) and not task.done()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    async def run(self) -> dict:
+        args = self.args
+        # 预热：建立连接、加载编码器、创建数据库
+        await self.run_turns(min(args.turns, 20), 1)
+
+        lag = LoopLagMonitor()
+        lag.start()
+        started = time.perf_counter()
+        await self.run_turns(args.turns, self.concurrency)
+        elapsed = time.perf_counter() - started
+        await lag.stop()
+
+        allocations = await self.measure_allocations(args.alloc_turns)
+        if self.module._http_client is not None:
+            await self.module._http_client.aclose()
+
+        result = {
+            "filter": self.filter_name,
+            "messages": self.messages,
+            "concurrency": self.concurrency,
+            "turns": args.turns,
+            "turns_per_sec": args.turns / elapsed,
+            "loop_max_lag_ms": lag.max_lag * 1000,
+            "loop_blocked_ms": lag.blocked * 1000,
+            **allocations,
+        }
+        for stage, samples in self.latencies.items():
+            # 只统计正式压测阶段的样本
+            samples = samples[min(args.turns, 20) :][: args.turns]
+            if samples:
+                result[f"{stage}_p50_ms"] = percentile(samples, 0.5) * 1000
+                result[f"{stage}_p99_ms"] = percentile(samples, 0.99) * 1000
+        return result
+
+
+def print_table(results: list):
+    columns = [
+        ("filter", "{:<28}"),
+        ("messages", "{:>5}"),
+        ("concurrency", "{:>5}"),
+        ("turns_per_sec", "{:>9.1f}"),
+        ("inlet_p50_ms", "{:>8.2f}"),
+        ("inlet_p99_ms", "{:>8.2f}"),
+        ("outlet_p50_ms", "{:>8.2f}"),
+        ("outlet_p99_ms", "{:>8.2f}"),
+        ("action_p50_ms", "{:>8.2f}"),
+        ("action_p99_ms", "{:>8.2f}"),
+        ("loop_max_lag_ms", "{:>8.2f}"),
+        ("loop_blocked_ms", "{:>9.1f}"),
+        ("peak_kib", "{:>9.1f}"),
+        ("retained_kib_per_turn", "{:>7.2f}"),
+    ]
+    headers = [
+        "filter", "msgs", "conc", "turns/s", "in p50", "in p99", "out p50", "out p99",
+        "act p50", "act p99", "max lag", "blocked", "peak KiB", "KiB/turn",
+    ]
+    widths = [len(fmt.format(0 if key != "filter" else "")) for key, fmt in columns]
+    print("  ".join(header.rjust(width) for header, width in zip(headers, widths)))
+    for result in results:
+        cells = []
+        for (key, fmt), width in zip(columns, widths):
+            value = result.get(key)
+            cells.append(fmt.format(value) if value is not None else "-".rjust(width))
+        print("  ".join(cells))
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    """与基线比较：吞吐下降或 p99 延迟上升超过容差即视为回归"""
+    with open(baseline_path) as f:
+        baseline = {
+            (r["filter"], r["messages"], r["concurrency"]): r for r in json.load(f)
+        }
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(
+            (result["filter"], result["messages"], result["concurrency"])
+        )
+        if previous is None:
+            continue
+        if result["turns_per_sec"] < previous["turns_per_sec"] * (1 - tolerance):
+            regressions.append((result, "turns_per_sec"))
+        for key in ("inlet_p99_ms", "outlet_p99_ms", "action_p99_ms"):
+            if key in result and key in previous:
+                if result[key] > previous[key] * (1 + tolerance):
+                    regressions.append((result, key))
+    return regressions
+
+
+def parse_ints(value: str) -> list:
+    return [int(item) for item in value.split(",") if item]
+
+
+async def main_async(args) -> list:
+    server = StandInMonitor(args.server_latency / 1000)
+    server.start()
+    results = []
+    try:
+        for filter_name in args.filters.split(","):
+            for messages in args.messages:
+                for concurrency in args.concurrency:
+                    scenario = Scenario(args, filter_name, messages, concurrency, server)
+                    try:
+                        result = await scenario.run()
+                    finally:
+                        await scenario.close()
+                    results.append(result)
+                    print(
+                        f"完成 {filter_name} 消息数={messages} 并发={concurrency}",
+                        file=sys.stderr,
+                    )
+    finally:
+        server.stop()
+    print(f"监控服务收到的请求: {dict(server.requests)}", file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OpenWebUI 监控函数的基准与压测",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--filters", default=",".join(FILTERS))
+    parser.add_argument("--messages", type=parse_ints, default=[10, 100])
+    parser.add_argument("--message-chars", type=int, default=1000)
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 16])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--alloc-turns", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=50, help="每轮流式输出的块数")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--server-latency", type=float, default=0.0, help="模拟的监控服务延迟（毫秒）"
+    )
+    parser.add_argument("--no-usage", action="store_true", help="回复不带 usage，走 token 计数路径")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，可作为之后的基线")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    # 函数自身的调试输出转到 stderr，stdout 只保留结果表格
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(main_async(args))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for result, key in regressions:
+            print(
+                f"回归: {result['filter']} 消息数={result['messages']} "
+                f"并发={result['concurrency']} {key}={result[key]:.2f}"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
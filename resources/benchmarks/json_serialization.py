@@ -0,0 +1,142 @@
+"""inlet/outlet 序列化微基准：对比标准库 json 与快速编码路径在长对话下每轮消耗的 CPU 时间
+
+用法: python resources/benchmarks/json_serialization.py [--messages 200] [--turns 500]
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+from pydantic import BaseModel
+
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(__file__), "..", "functions")
+
+
+def load_filter_module():
+    spec = importlib.util.spec_from_file_location(
+        "openwebui_monitor", os.path.join(FUNCTIONS_DIR, "openwebui_monitor.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class UserValves(BaseModel):
+    show_cost: bool = True
+    language: str = "zh"
+
+
+def build_conversation(messages: int, message_chars: int) -> dict:
+    text = ("监控 usage monitor " * message_chars)[:message_chars]
+    return {
+        "model": "gpt-4o",
+        "messages": [
+            {
+                "id": f"m{i}",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": text,
+            }
+            for i in range(messages)
+        ],
+    }
+
+
+def cpu_per_turn(fn, turns: int) -> float:
+    """返回每轮平均 CPU 时间（微秒）"""
+    fn()
+    started = time.process_time()
+    for _ in range(turns):
+        fn()
+    return (time.process_time() - started) / turns * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--message-chars", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=500)
+    args = parser.parse_args()
+
+    monitor = load_filter_module()
+    body = build_conversation(args.messages, args.message_chars)
+    user = {
+        "id": "user-1",
+        "email": "user@example.com",
+        "name": "User",
+        "role": "user",
+        "valves": UserValves(),
+    }
+
+    def legacy_inlet():
+        # 旧实现：复制 __user__、导出 valves，并把整段对话一起编码
+        user_dict = dict(user)
+        user_dict["valves"] = user_dict["valves"].model_dump()
+        json.dumps({"user": user_dict, "body": body}).encode("utf-8")
+
+    headers = monitor.UserHeaderCache()
+    fast_encode = monitor.json_encoder(True)
+
+    def cached_inlet():
+        b'{"user":' + headers.get(user, fast_encode) + b"}"
+
+    messages = body["messages"]
+    payload = {
+        "version": 2,
+        "model": body["model"],
+        "user": {"id": user["id"], "name": user["name"]},
+        "usage": None,
+        "messages": [
+            {
+                "role": message["role"],
+                "hash": monitor.content_hash(message["content"]),
+                "content": message["content"],
+            }
+            for message in messages
+        ],
+    }
+    stdlib_encode = monitor.json_encoder(False)
+    events = [(f"e{i}", fast_encode(payload)) for i in range(50)]
+
+    def legacy_batch():
+        json.dumps(
+            {
+                "events": [
+                    {"id": event_id, "payload": json.loads(encoded)}
+                    for event_id, encoded in events
+                ]
+            }
+        ).encode("utf-8")
+
+    def spliced_batch():
+        b'{"events":[' + b",".join(
+            b'{"id":' + fast_encode(event_id) + b',"payload":' + encoded + b"}"
+            for event_id, encoded in events
+        ) + b"]}"
+
+    fast_name = "stdlib"
+    for candidate in ("orjson", "msgspec"):
+        if importlib.util.find_spec(candidate):
+            fast_name = candidate
+            break
+
+    rows = [
+        ("inlet: 整段 body + model_dump", legacy_inlet, args.turns),
+        ("inlet: 缓存的用户信息", cached_inlet, args.turns),
+        ("outlet: json 标准库", lambda: stdlib_encode(payload), args.turns),
+        (f"outlet: {fast_name}", lambda: fast_encode(payload), args.turns),
+        ("batch x50: 解析后重新编码", legacy_batch, max(1, args.turns // 10)),
+        ("batch x50: 直接拼接", spliced_batch, max(1, args.turns // 10)),
+    ]
+
+    print(
+        f"对话 {args.messages} 条消息 x {args.message_chars} 字符，快速编码器: {fast_name}"
+    )
+    for label, fn, turns in rows:
+        print(f"{label:<32} {cpu_per_turn(fn, turns):>12.1f} µs/轮")
+
+
+if __name__ == "__main__":
+    main()
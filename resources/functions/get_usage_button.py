@@ -9,11 +9,152 @@ required_open_webui_version: 0.4.0
 
 from pydantic import BaseModel, Field
 from typing import Optional, Union, Generator, Iterator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import requests
 import asyncio
+import functools
 import json
+import sqlite3
+import sys
+import threading
+import types
+
+
+RECORD_DIR = "/app/backend/data/record"
+RECORD_COLUMNS = (
+    "message_id",
+    "chat_id",
+    "model",
+    "input_tokens",
+    "output_tokens",
+    "total_cost",
+    "new_balance",
+    "elapsed_time",
+    "tokens_per_sec",
+    "created_at",
+)
+# SQLite 单条语句的参数个数上限（旧版本为 999）
+MAX_QUERY_PARAMS = 900
+
+
+class RecordStore:
+    """只读访问监控过滤器写入的计费记录数据库，兼容旧版 JSON 文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None and os.path.exists(self.path):
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._conn = conn
+        return self._conn
+
+    def get(self, message_id: str) -> Optional[dict]:
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records WHERE message_id = ?",
+                        (message_id,),
+                    ).fetchone()
+                except sqlite3.OperationalError:
+                    row = None
+                if row is not None:
+                    return {key: row[key] for key in row.keys() if row[key] is not None}
+        return self._load_json(message_id)
+
+    def get_many(self, message_ids: list) -> dict:
+        """按主键一次批量读取多条消息的记录，返回 {message_id: 记录}，缺失的消息不在结果中"""
+        records = {}
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                for start in range(0, len(message_ids), MAX_QUERY_PARAMS):
+                    chunk = message_ids[start : start + MAX_QUERY_PARAMS]
+                    try:
+                        rows = conn.execute(
+                            f"SELECT {', '.join(RECORD_COLUMNS)} FROM usage_records "
+                            f"WHERE message_id IN ({', '.join('?' * len(chunk))})",
+                            chunk,
+                        ).fetchall()
+                    except sqlite3.OperationalError:
+                        rows = []
+                    for row in rows:
+                        records[row["message_id"]] = {
+                            key: row[key] for key in row.keys() if row[key] is not None
+                        }
+
+        for message_id in message_ids:
+            if message_id not in records:
+                record = self._load_json(message_id)
+                if record is not None:
+                    records[message_id] = record
+        return records
+
+    def _load_json(self, message_id: str) -> Optional[dict]:
+        # 过滤器尚未迁移的旧版记录，与数据库在同一目录（过滤器默认从这里导入）
+        file_path = os.path.join(
+            os.path.dirname(os.path.abspath(self.path)), f"{message_id}.json"
+        )
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as f:
+            return json.load(f)
+
+
+SHARED_CACHE_MODULE = "openwebui_monitor_shared"
+
+
+class RecordCache:
+    """进程内共享的最近计费记录 LRU，监控过滤器写入时填充，计费按钮点击时优先命中"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 1048576):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # 过滤器和计费按钮是两个独立加载的函数模块，通过 sys.modules 中的同名模块共享数据
+        shared = sys.modules.setdefault(
+            SHARED_CACHE_MODULE, types.ModuleType(SHARED_CACHE_MODULE)
+        )
+        self._state = shared.__dict__.setdefault(
+            "record_cache",
+            {"lock": threading.Lock(), "entries": OrderedDict(), "bytes": 0},
+        )
+
+    def put(self, message_id: str, record: dict):
+        size = len(json.dumps(record, separators=(",", ":")))
+        state = self._state
+        with state["lock"]:
+            old = state["entries"].pop(message_id, None)
+            if old is not None:
+                state["bytes"] -= old[0]
+            state["entries"][message_id] = (size, dict(record))
+            state["bytes"] += size
+            while state["entries"] and (
+                len(state["entries"]) > self.max_entries
+                or state["bytes"] > self.max_bytes
+            ):
+                evicted_size, _ = state["entries"].popitem(last=False)[1]
+                state["bytes"] -= evicted_size
+
+    def get(self, message_id: str) -> Optional[dict]:
+        state = self._state
+        with state["lock"]:
+            entry = state["entries"].get(message_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            state["entries"].move_to_end(message_id)
+            self.hits += 1
+            return dict(entry[1])
 
 
 class Action:
@@ -38,88 +179,103 @@ class Action:
             description="是否显示每秒输出token数",
             json_schema_extra={"ui:group": "显示设置"},
         )
+        display_mode: str = Field(
+            default="message",
+            description="显示模式：message 显示最新一条回复，chat 汇总整个对话",
+            json_schema_extra={"ui:group": "显示设置"},
+        )
+        record_db_path: str = Field(
+            default=f"{RECORD_DIR}/usage_records.db",
+            description="计费记录数据库路径（需与监控过滤器一致）",
+            json_schema_extra={"ui:group": "存储设置"},
+        )
+        io_workers: int = Field(
+            default=2,
+            description="读取计费记录使用的线程数",
+            json_schema_extra={"ui:group": "存储设置"},
+        )
+        record_cache_entries: int = Field(
+            default=1000,
+            description="内存中缓存的最近计费记录条数",
+            json_schema_extra={"ui:group": "存储设置"},
+        )
+        record_cache_bytes: int = Field(
+            default=1048576,
+            description="计费记录缓存的内存上限（字节）",
+            json_schema_extra={"ui:group": "存储设置"},
+        )
+
+    class UserValves(BaseModel):
+        display_mode: str = Field(
+            default="",
+            description="显示模式：message 或 chat，留空使用管理员设置",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
-        pass
-
-    async def action(
-        self,
-        body: dict,
-        __user__=None,
-        __event_emitter__=None,
-        __event_call__=None,
-    ) -> Optional[dict]:
-        print(f"action:{__name__}")
-
-        # 查找最新一条assistant消息的索引和内容
-        messages = body.get("messages", [])
-        assistant_indexes = [
-            i for i, msg in enumerate(messages) if msg.get("role") == "assistant"
-        ]
-
-        if not assistant_indexes:
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {"description": "没有找到assistant消息", "done": True},
-                    }
-                )
-            return None
-
-        # 获取最后一条assistant消息的索引和内容
-        last_assistant_index = assistant_indexes[-1]
-        last_assistant_message = messages[last_assistant_index]
+        self._records: Optional[RecordStore] = None
+        self.record_cache = RecordCache(
+            self.valves.record_cache_entries, self.valves.record_cache_bytes
+        )
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_workers = 0
 
-        # 获取消息 ID
-        message_id = last_assistant_message.get("id")
+    def _get_executor(self) -> ThreadPoolExecutor:
+        workers = max(1, self.valves.io_workers)
+        if self._executor is None or self._executor_workers != workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="owm-usage-io"
+            )
+            self._executor_workers = workers
+        return self._executor
 
-        if not message_id:
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {"description": "无法获取消息ID", "done": True},
-                    }
-                )
-            return None
+    def _get_records(self) -> RecordStore:
+        if self._records is None or self._records.path != self.valves.record_db_path:
+            self._records = RecordStore(self.valves.record_db_path)
+        return self._records
 
-        # 构建文件路径
-        file_path = os.path.join("/app/backend/data/record", f"{message_id}.json")
+    def _display_mode(self, __user__: Optional[dict]) -> str:
+        user_valves = (__user__ or {}).get("valves")
+        mode = getattr(user_valves, "display_mode", None)
+        if mode is None and isinstance(user_valves, dict):
+            mode = user_valves.get("display_mode")
+        return (mode or self.valves.display_mode or "message").lower()
 
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": f"未查找到该消息的计费记录，请联系管理员",
-                            "done": True,
-                        },
-                    }
-                )
-            return None
+    async def _emit_status(self, __event_emitter__, description: str):
+        if __event_emitter__:
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {"description": description, "done": True},
+                }
+            )
 
-        # 读取统计信息
-        try:
-            with open(file_path, "r") as f:
-                stats_data = json.load(f)
-        except Exception as e:
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": f"读取统计文件失败: {str(e)}",
-                            "done": True,
-                        },
-                    }
+    async def _load_records(self, message_ids: list) -> dict:
+        """优先命中过滤器刚写入的内存缓存，其余消息在线程池中一次批量查询数据库"""
+        self.record_cache.max_entries = self.valves.record_cache_entries
+        self.record_cache.max_bytes = self.valves.record_cache_bytes
+        records = {}
+        missing = []
+        for message_id in message_ids:
+            record = self.record_cache.get(message_id)
+            if record is None:
+                missing.append(message_id)
+            else:
+                records[message_id] = record
+        if missing:
+            # 在线程池中读取，避免磁盘延迟阻塞事件循环
+            records.update(
+                await asyncio.get_running_loop().run_in_executor(
+                    self._get_executor(),
+                    functools.partial(self._get_records().get_many, missing),
                 )
-            return None
+            )
+        return records
 
-        # 构建状态栏显示的统计信息
+    def _format_stats(self, stats_data: dict) -> str:
+        """构建状态栏显示的单条消息统计信息"""
         stats_array = []
 
         if self.valves.show_cost and "total_cost" in stats_data:
@@ -140,28 +296,150 @@ class Action:
             elapsed_time = stats_data["elapsed_time"]
             stats_array.append(f"Time: {elapsed_time:.2f}s")
 
-            # 计算每秒输出速度
-            if (
-                self.valves.show_tokens_per_sec
-                and "output_tokens" in stats_data
-                and elapsed_time > 0
-            ):
-                stats_array.append(
-                    f"{(stats_data['output_tokens']/elapsed_time):.2f} T/s"
+        # 每秒输出速度：优先使用过滤器记录的纯解码速度，旧记录才按总耗时估算
+        if self.valves.show_tokens_per_sec:
+            tokens_per_sec = stats_data.get("tokens_per_sec")
+            if not tokens_per_sec and stats_data.get("elapsed_time"):
+                tokens_per_sec = (
+                    stats_data.get("output_tokens", 0) / stats_data["elapsed_time"]
                 )
+            if tokens_per_sec:
+                stats_array.append(f"{tokens_per_sec:.2f} T/s")
 
-        stats = " | ".join(stat for stat in stats_array)
+        return " | ".join(stat for stat in stats_array)
 
-        # 发送状态更新
-        if __event_emitter__:
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "description": stats,
-                        "done": True,
-                    },
-                }
+    @staticmethod
+    def _summarize(records: list) -> dict:
+        """累加多条记录；吞吐量按各条的解码耗时（输出 token / 解码速度）合计，缺少解码速度的按总耗时"""
+        summary = {
+            "count": len(records),
+            "total_cost": 0.0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "elapsed_time": 0.0,
+            "timed_output_tokens": 0,
+            "decode_time": 0.0,
+        }
+        for record in records:
+            summary["total_cost"] += record.get("total_cost") or 0.0
+            summary["input_tokens"] += record.get("input_tokens") or 0
+            summary["output_tokens"] += record.get("output_tokens") or 0
+            if record.get("elapsed_time"):
+                summary["elapsed_time"] += record["elapsed_time"]
+            output_tokens = record.get("output_tokens")
+            if output_tokens is None:
+                continue
+            if record.get("tokens_per_sec"):
+                summary["decode_time"] += output_tokens / record["tokens_per_sec"]
+            elif record.get("elapsed_time"):
+                summary["decode_time"] += record["elapsed_time"]
+            else:
+                continue
+            summary["timed_output_tokens"] += output_tokens
+        return summary
+
+    def _format_summary(self, label: str, summary: dict) -> str:
+        stats_array = [f"{label}: {summary['count']} 条回复"]
+        if self.valves.show_cost:
+            stats_array.append(f"Cost: ${summary['total_cost']:.6f}")
+        if self.valves.show_tokens:
+            stats_array.append(
+                f"Token: {summary['input_tokens']}+{summary['output_tokens']}"
+            )
+        if summary["elapsed_time"] > 0:
+            stats_array.append(f"Time: {summary['elapsed_time']:.2f}s")
+        if self.valves.show_tokens_per_sec and summary["decode_time"] > 0:
+            stats_array.append(
+                f"{summary['timed_output_tokens'] / summary['decode_time']:.2f} T/s"
+            )
+        return " | ".join(stats_array)
+
+    async def _chat_summary(self, messages: list, __event_emitter__) -> None:
+        """汇总对话中所有 assistant 消息：先逐个模型输出分项，最后一条状态为全对话合计"""
+        message_ids = [
+            msg["id"]
+            for msg in messages
+            if msg.get("role") == "assistant" and msg.get("id")
+        ]
+        if not message_ids:
+            await self._emit_status(__event_emitter__, "没有找到assistant消息")
+            return None
+
+        try:
+            records = await self._load_records(message_ids)
+        except Exception as e:
+            await self._emit_status(__event_emitter__, f"读取计费记录失败: {str(e)}")
+            return None
+
+        if not records:
+            await self._emit_status(
+                __event_emitter__, "未查找到该对话的计费记录，请联系管理员"
+            )
+            return None
+
+        # 按对话顺序排列，余额取最后一条有记录的回复
+        ordered = [records[message_id] for message_id in message_ids if message_id in records]
+        by_model: dict = {}
+        for record in ordered:
+            by_model.setdefault(record.get("model") or "unknown", []).append(record)
+
+        if len(by_model) > 1:
+            for model, model_records in by_model.items():
+                await self._emit_status(
+                    __event_emitter__,
+                    self._format_summary(model, self._summarize(model_records)),
+                )
+
+        total = self._format_summary("对话合计", self._summarize(ordered))
+        if self.valves.show_balance and "new_balance" in ordered[-1]:
+            total += f" | Balance: ${ordered[-1]['new_balance']:.6f}"
+        if len(ordered) < len(message_ids):
+            total += f" | {len(message_ids) - len(ordered)} 条回复缺少计费记录"
+        await self._emit_status(__event_emitter__, total)
+        return None
+
+    async def action(
+        self,
+        body: dict,
+        __user__=None,
+        __event_emitter__=None,
+        __event_call__=None,
+    ) -> Optional[dict]:
+        print(f"action:{__name__}")
+
+        messages = body.get("messages", [])
+        if self._display_mode(__user__) == "chat":
+            return await self._chat_summary(messages, __event_emitter__)
+
+        # 从末尾向前查找最新一条assistant消息
+        last_assistant_message = next(
+            (msg for msg in reversed(messages) if msg.get("role") == "assistant"),
+            None,
+        )
+        if last_assistant_message is None:
+            await self._emit_status(__event_emitter__, "没有找到assistant消息")
+            return None
+
+        # 获取消息 ID
+        message_id = last_assistant_message.get("id")
+
+        if not message_id:
+            await self._emit_status(__event_emitter__, "无法获取消息ID")
+            return None
+
+        # 读取统计信息：优先命中过滤器刚写入的内存缓存，未命中再读数据库
+        try:
+            stats_data = (await self._load_records([message_id])).get(message_id)
+        except Exception as e:
+            await self._emit_status(__event_emitter__, f"读取计费记录失败: {str(e)}")
+            return None
+
+        if stats_data is None:
+            await self._emit_status(
+                __event_emitter__, "未查找到该消息的计费记录，请联系管理员"
             )
+            return None
 
+        # 发送状态更新
+        await self._emit_status(__event_emitter__, self._format_stats(stats_data))
         return None
@@ -1,7 +1,19 @@
 from typing import Optional, Callable, Any, Awaitable
+from collections import OrderedDict
 from pydantic import Field, BaseModel
-import requests
+import asyncio
+import bisect
+import gzip
+import hashlib
+import httpx
+import json
+import math
+import os
+import sqlite3
+import string
+import threading
 import time
+import uuid
 
 
 TRANSLATIONS = {
@@ -9,28 +21,1611 @@ TRANSLATIONS = {
         "network_request_failed": "Network request failed: {error}",
         "request_failed": "Request failed: [{error_type}] {error_msg}",
         "insufficient_balance": "Insufficient balance: Current balance `{balance:.4f}`",
+        "insufficient_budget": "Insufficient balance: this request may cost up to `{estimate:.4f}`, available `{balance:.4f}`",
+        "rate_limited_user": "Rate limit reached ({limit}), please retry in {wait}s",
+        "rate_limited_model": "Model {model} is busy ({limit}), please retry in {wait}s",
         "unknown_error": "Unknown error",
         "api_key_invalid": "API key validation failed",
         "cost": "Cost: ${cost:.4f}",
         "balance": "Balance: ${balance:.4f}",
         "tokens": "Tokens: {input}+{output}",
         "time_spent": "Time: {time:.2f}s",
-        "tokens_per_sec": "{tokens_per_sec:.2f} T/s"
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "Billing queued",
+        "monitor_unavailable": "Monitor service unavailable",
+        "ttft": "TTFT: {ttft:.2f}s"
     },
     "zh": {
         "network_request_failed": "网络请求失败: {error}",
         "request_failed": "请求失败: [{error_type}] {error_msg}",
         "insufficient_balance": "余额不足: 当前余额 `{balance:.4f}`",
+        "insufficient_budget": "余额不足: 本次请求预计费用 `{estimate:.4f}`，可用余额 `{balance:.4f}`",
+        "rate_limited_user": "请求过于频繁（限制 {limit}），请 {wait} 秒后重试",
+        "rate_limited_model": "模型 {model} 繁忙（限制 {limit}），请 {wait} 秒后重试",
         "unknown_error": "未知错误",
         "api_key_invalid": "API密钥验证失败",
         "cost": "费用: ¥{cost:.4f}",
         "balance": "余额: ¥{balance:.4f}",
         "tokens": "Token: {input}+{output}",
         "time_spent": "耗时: {time:.2f}s",
-        "tokens_per_sec": "{tokens_per_sec:.2f} T/s"
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "计费已排队",
+        "monitor_unavailable": "监控服务不可用",
+        "ttft": "首字: {ttft:.2f}s"
+    },
+    "ja": {
+        "network_request_failed": "ネットワークリクエストに失敗しました: {error}",
+        "request_failed": "リクエストに失敗しました: [{error_type}] {error_msg}",
+        "insufficient_balance": "残高不足: 現在の残高 `{balance:.4f}`",
+        "insufficient_budget": "残高不足: このリクエストの推定費用 `{estimate:.4f}`、利用可能残高 `{balance:.4f}`",
+        "rate_limited_user": "リクエストが多すぎます（上限 {limit}）。{wait} 秒後に再試行してください",
+        "rate_limited_model": "モデル {model} は混雑しています（上限 {limit}）。{wait} 秒後に再試行してください",
+        "unknown_error": "不明なエラー",
+        "api_key_invalid": "API キーの検証に失敗しました",
+        "cost": "費用: ${cost:.4f}",
+        "balance": "残高: ${balance:.4f}",
+        "tokens": "トークン: {input}+{output}",
+        "time_spent": "時間: {time:.2f}s",
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "課金は処理待ちです",
+        "monitor_unavailable": "モニターサービスを利用できません",
+        "ttft": "初回トークン: {ttft:.2f}s"
+    },
+    "ko": {
+        "network_request_failed": "네트워크 요청 실패: {error}",
+        "request_failed": "요청 실패: [{error_type}] {error_msg}",
+        "insufficient_balance": "잔액 부족: 현재 잔액 `{balance:.4f}`",
+        "insufficient_budget": "잔액 부족: 이 요청의 예상 비용 `{estimate:.4f}`, 사용 가능 잔액 `{balance:.4f}`",
+        "rate_limited_user": "요청이 너무 많습니다 (제한 {limit}). {wait}초 후에 다시 시도하세요",
+        "rate_limited_model": "모델 {model}이(가) 혼잡합니다 (제한 {limit}). {wait}초 후에 다시 시도하세요",
+        "unknown_error": "알 수 없는 오류",
+        "api_key_invalid": "API 키 검증 실패",
+        "cost": "비용: ${cost:.4f}",
+        "balance": "잔액: ${balance:.4f}",
+        "tokens": "토큰: {input}+{output}",
+        "time_spent": "시간: {time:.2f}s",
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "과금 대기 중",
+        "monitor_unavailable": "모니터 서비스를 사용할 수 없음",
+        "ttft": "첫 토큰: {ttft:.2f}s"
+    },
+    "fr": {
+        "network_request_failed": "Échec de la requête réseau : {error}",
+        "request_failed": "Échec de la requête : [{error_type}] {error_msg}",
+        "insufficient_balance": "Solde insuffisant : solde actuel `{balance:.4f}`",
+        "insufficient_budget": "Solde insuffisant : cette requête peut coûter jusqu'à `{estimate:.4f}`, disponible `{balance:.4f}`",
+        "rate_limited_user": "Limite de requêtes atteinte ({limit}), réessayez dans {wait} s",
+        "rate_limited_model": "Le modèle {model} est saturé ({limit}), réessayez dans {wait} s",
+        "unknown_error": "Erreur inconnue",
+        "api_key_invalid": "Échec de la validation de la clé API",
+        "cost": "Coût : ${cost:.4f}",
+        "balance": "Solde : ${balance:.4f}",
+        "tokens": "Jetons : {input}+{output}",
+        "time_spent": "Durée : {time:.2f}s",
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "Facturation en attente",
+        "monitor_unavailable": "Service de suivi indisponible",
+        "ttft": "Premier jeton : {ttft:.2f}s"
+    },
+    "de": {
+        "network_request_failed": "Netzwerkanfrage fehlgeschlagen: {error}",
+        "request_failed": "Anfrage fehlgeschlagen: [{error_type}] {error_msg}",
+        "insufficient_balance": "Guthaben nicht ausreichend: aktuelles Guthaben `{balance:.4f}`",
+        "insufficient_budget": "Guthaben nicht ausreichend: diese Anfrage kann bis zu `{estimate:.4f}` kosten, verfügbar `{balance:.4f}`",
+        "rate_limited_user": "Anfragelimit erreicht ({limit}), bitte in {wait} s erneut versuchen",
+        "rate_limited_model": "Modell {model} ist ausgelastet ({limit}), bitte in {wait} s erneut versuchen",
+        "unknown_error": "Unbekannter Fehler",
+        "api_key_invalid": "API-Schlüssel ungültig",
+        "cost": "Kosten: ${cost:.4f}",
+        "balance": "Guthaben: ${balance:.4f}",
+        "tokens": "Tokens: {input}+{output}",
+        "time_spent": "Dauer: {time:.2f}s",
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "Abrechnung ausstehend",
+        "monitor_unavailable": "Monitor-Dienst nicht erreichbar",
+        "ttft": "Erstes Token: {ttft:.2f}s"
+    },
+    "es": {
+        "network_request_failed": "Error en la solicitud de red: {error}",
+        "request_failed": "La solicitud falló: [{error_type}] {error_msg}",
+        "insufficient_balance": "Saldo insuficiente: saldo actual `{balance:.4f}`",
+        "insufficient_budget": "Saldo insuficiente: esta solicitud puede costar hasta `{estimate:.4f}`, disponible `{balance:.4f}`",
+        "rate_limited_user": "Límite de solicitudes alcanzado ({limit}), inténtelo de nuevo en {wait} s",
+        "rate_limited_model": "El modelo {model} está saturado ({limit}), inténtelo de nuevo en {wait} s",
+        "unknown_error": "Error desconocido",
+        "api_key_invalid": "Error al validar la clave API",
+        "cost": "Costo: ${cost:.4f}",
+        "balance": "Saldo: ${balance:.4f}",
+        "tokens": "Tokens: {input}+{output}",
+        "time_spent": "Tiempo: {time:.2f}s",
+        "tokens_per_sec": "{tokens_per_sec:.2f} T/s",
+        "billing_queued": "Facturación en cola",
+        "monitor_unavailable": "Servicio de monitoreo no disponible",
+        "ttft": "Primer token: {ttft:.2f}s"
     }
 }
 
+
+def resolve_translations(language: str) -> dict:
+    """按语言合并翻译表：zh-CN 这类地区代码退回到 zh，缺失的键使用英文"""
+    language = (language or "en").strip()
+    for candidate in (language, language.lower(), language.replace("_", "-").split("-")[0].lower()):
+        if candidate in TRANSLATIONS:
+            return {**TRANSLATIONS["en"], **TRANSLATIONS[candidate]}
+    return dict(TRANSLATIONS["en"])
+
+
+class StatusRenderer:
+    """按 valves 配置预编译的状态栏渲染器，每条消息只需一次 format_map
+
+    每种可用字段的组合只拼接一次模板；不可用的字段（如非流式响应没有首字延迟）所在的段会被省略。
+    """
+
+    # 状态栏各段的顺序：(控制显示的 valve, 翻译键, 依赖的字段)
+    SEGMENTS = (
+        ("show_cost", "cost", ("cost",)),
+        ("show_balance", "balance", ("balance",)),
+        ("show_tokens", "tokens", ("input", "output")),
+        (None, "time_spent", ("time",)),
+        ("show_tokens_per_sec", "ttft", ("ttft",)),
+        ("show_tokens_per_sec", "tokens_per_sec", ("tokens_per_sec",)),
+        (None, "billing_queued", ("queued",)),
+    )
+    SEPARATOR = " | "
+    # 自定义模板可用的字段及用于校验模板的示例值，类型与 render 实际收到的一致
+    FIELDS = {
+        "cost": 0.1,
+        "balance": 1.0,
+        "input": 1,
+        "output": 1,
+        "time": 1.0,
+        "ttft": 0.1,
+        "tokens_per_sec": 1.0,
+        "queued": True,
+    }
+
+    def __init__(self, segments: list, default: Optional[list] = None):
+        self.segments = segments
+        # 自定义模板渲染失败时退回的默认分段
+        self.default = default
+        self._templates: dict = {}
+
+    @classmethod
+    def compile(cls, valves: Any, template: str = "") -> "StatusRenderer":
+        texts = resolve_translations(valves.language)
+        default = [
+            (texts[key], fields)
+            for flag, key, fields in cls.SEGMENTS
+            if flag is None or getattr(valves, flag)
+        ]
+        if not template:
+            return cls(default)
+
+        # 自定义模板按 | 分段，每段只在其引用的字段都可用时显示
+        segments = []
+        try:
+            for part in template.split("|"):
+                part = part.strip()
+                if not part:
+                    continue
+                fields = tuple(
+                    name.split(".")[0].split("[")[0]
+                    for _, name, _, _ in string.Formatter().parse(part)
+                    if name
+                )
+                part.format_map(cls.FIELDS)
+                segments.append((part, fields))
+        except Exception as e:
+            print(f"OpenWebUI Monitor: 状态栏模板无效，使用默认格式: {e}")
+            return cls(default)
+        return cls(segments, default)
+
+    def render(self, values: dict) -> str:
+        key = frozenset(values)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = self.SEPARATOR.join(
+                text
+                for text, fields in self.segments
+                if all(field in values for field in fields)
+            )
+        try:
+            return template.format_map(values)
+        except Exception as e:
+            if self.default is None:
+                raise
+            # 校验时未覆盖的情况（如某个值的类型不同）不能让 outlet 失败，之后改用默认格式
+            print(f"OpenWebUI Monitor: 状态栏模板渲染失败，使用默认格式: {e}")
+            self.segments, self.default = self.default, None
+            self._templates.clear()
+            return self.render(values)
+
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_key: Optional[tuple] = None
+
+
+async def get_http_client(http2: bool = False, max_connections: int = 100) -> httpx.AsyncClient:
+    """获取进程内共享的异步 HTTP 客户端，所有 inlet/outlet 调用复用同一个 keep-alive 连接池"""
+    global _http_client, _http_client_key
+
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            http2 = False
+
+    # 连接绑定在创建它的事件循环上，循环或配置变化时需要重建客户端
+    key = (asyncio.get_running_loop(), http2, max_connections)
+    if _http_client is None or _http_client.is_closed or _http_client_key != key:
+        old_client = _http_client
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60,
+            ),
+        )
+        _http_client_key = key
+        if old_client is not None and not old_client.is_closed:
+            try:
+                await old_client.aclose()
+            except Exception:
+                pass
+
+    return _http_client
+
+
+_json_encoders: dict = {}
+
+
+def json_encoder(fast: bool = True) -> Callable[[Any], bytes]:
+    """返回输出 UTF-8 字节的 JSON 编码函数：优先 orjson，其次 msgspec，都不可用时使用标准库"""
+    encoder = _json_encoders.get(fast)
+    if encoder is not None:
+        return encoder
+
+    def stdlib_encode(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+
+    fast_encode = None
+    if fast:
+        try:
+            import orjson
+
+            fast_encode = lambda data: orjson.dumps(
+                data, option=orjson.OPT_NON_STR_KEYS
+            )
+        except ImportError:
+            try:
+                import msgspec
+
+                fast_encode = msgspec.json.Encoder().encode
+            except ImportError:
+                pass
+
+    if fast_encode is None:
+        encoder = stdlib_encode
+    else:
+
+        def encoder(data: Any) -> bytes:
+            try:
+                return fast_encode(data)
+            except (TypeError, ValueError, OverflowError):
+                # 快速编码器不支持的值（如超过 64 位的整数）交给标准库处理
+                return stdlib_encode(data)
+
+    _json_encoders[fast] = encoder
+    return encoder
+
+
+# 超过该大小的请求体放到线程中压缩，避免阻塞事件循环
+COMPRESS_IN_THREAD_BYTES = 256 * 1024
+
+_zstandard: Any = None
+
+
+def zstd_available() -> bool:
+    """zstd 压缩依赖可选的 zstandard 包"""
+    global _zstandard
+    if _zstandard is None:
+        try:
+            import zstandard
+
+            _zstandard = zstandard
+        except ImportError:
+            _zstandard = False
+    return bool(_zstandard)
+
+
+def compress_body(content: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return _zstandard.ZstdCompressor(level=3).compress(content)
+    return gzip.compress(content, compresslevel=6, mtime=0)
+
+
+class UserHeaderCache:
+    """按用户 ID 缓存预先序列化的用户信息，inlet 不再每次复制 __user__ 并导出 valves"""
+
+    # 监控服务创建/更新用户时只用到这些字段
+    FIELDS = ("id", "email", "name", "role")
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, user: dict, encode: Callable[[Any], bytes]) -> bytes:
+        fields = tuple(user.get(field) for field in self.FIELDS)
+        entry = self._entries.get(fields[0])
+        if entry is not None and entry[0] == fields:
+            self._entries.move_to_end(fields[0])
+            return entry[1]
+
+        encoded = encode(dict(zip(self.FIELDS, fields)))
+        if fields[0]:
+            self._entries.pop(fields[0], None)
+            self._entries[fields[0]] = (fields, encoded)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return encoded
+
+
+def message_text(content: Any) -> str:
+    """把消息内容统一为纯文本，多模态消息只保留文本部分"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part.get("text", "")
+            for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return ""
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class TokenCounter:
+    """本地 token 计数，按模型选择编码，并按内容哈希缓存计数结果（LRU）"""
+
+    def __init__(
+        self,
+        default_encoding: str = "cl100k_base",
+        max_entries: int = 10000,
+        tokenize: Optional[Callable[[str, str], int]] = None,
+    ):
+        self.default_encoding = default_encoding
+        self.max_entries = max_entries
+        # 可替换的分词函数，签名为 (encoding_name, text) -> token 数
+        self.tokenize = tokenize or self._tiktoken_count
+        self._encodings: dict = {}
+        self._model_encodings: dict = {}
+        self._counts: "OrderedDict[tuple, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encoding_for(self, model: Optional[str]) -> str:
+        name = self._model_encodings.get(model)
+        if name is None:
+            name = self.default_encoding
+            try:
+                import tiktoken
+
+                name = tiktoken.encoding_for_model(model or "").name
+            except Exception:
+                pass
+            self._model_encodings[model] = name
+        return name
+
+    def _tiktoken_count(self, encoding_name: str, text: str) -> int:
+        encoding = self._encodings.get(encoding_name)
+        if encoding is None:
+            import tiktoken
+
+            encoding = tiktoken.get_encoding(encoding_name)
+            self._encodings[encoding_name] = encoding
+        return len(encoding.encode(text, disallowed_special=()))
+
+    async def prepare(self, model: Optional[str]) -> bool:
+        """首次加载编码可能需要下载词表，放到线程中执行；返回本地计数是否可用"""
+        encoding_name = self.encoding_for(model)
+        if self.tokenize != self._tiktoken_count:
+            return True
+        if encoding_name not in self._encodings:
+            try:
+                await asyncio.to_thread(self._tiktoken_count, encoding_name, "")
+            except Exception:
+                self._encodings[encoding_name] = False
+        return bool(self._encodings.get(encoding_name))
+
+    def count(self, model: Optional[str], text: str, key: str) -> int:
+        cache_key = (self.encoding_for(model), key)
+        count = self._counts.get(cache_key)
+        if count is not None:
+            self._counts.move_to_end(cache_key)
+            self.hits += 1
+            return count
+
+        self.misses += 1
+        count = self.tokenize(cache_key[0], text)
+        self._counts[cache_key] = count
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return count
+
+
+def stream_timing(context: dict) -> Optional[dict]:
+    """根据 stream 钩子记录的时间点计算首 token 延迟和解码耗时（毫秒）"""
+    first_token_at = context.get("first_token_at")
+    if first_token_at is None or not context.get("start_time"):
+        return None
+    return {
+        "ttft_ms": (first_token_at - context["start_time"]) * 1000,
+        "decode_ms": (context["last_token_at"] - first_token_at) * 1000,
+        "chunks": context["chunks"],
+    }
+
+
+def outlet_message_id(body: dict) -> Optional[str]:
+    """outlet 的幂等键：assistant 消息 ID（与计费按钮查找记录用的 ID 一致），其次 body.id；都没有时为 None"""
+    messages = body.get("messages") or []
+    return (messages[-1].get("id") if messages else None) or body.get("id") or None
+
+
+def decode_tokens_per_sec(timing: Optional[dict], output_tokens: int) -> Optional[float]:
+    """纯解码阶段的吞吐：首 token 之后的 token 数除以解码耗时"""
+    if not timing or timing["decode_ms"] <= 0 or output_tokens <= 1:
+        return None
+    return (output_tokens - 1) / (timing["decode_ms"] / 1000)
+
+
+class MonitorUnavailableError(Exception):
+    """熔断器打开期间不再请求监控服务"""
+
+
+class CircuitBreaker:
+    """监控服务的熔断器：连续失败达到阈值后打开，冷却后放行少量探测请求（半开）"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_time: float = 30,
+        half_open_probes: int = 1,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.rejected = 0
+        self.transitions = {self.OPEN: 0, self.HALF_OPEN: 0, self.CLOSED: 0}
+
+    def _transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            self.transitions[state] += 1
+            self.probes = 0
+            print(f"OpenWebUI Monitor: 熔断器状态切换为 {state}")
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_time:
+                self.rejected += 1
+                return False
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            # 探测请求被取消时不会回报结果，超过冷却时间后允许重新探测
+            if (
+                self.probes >= self.half_open_probes
+                and time.monotonic() - self.opened_at < self.recovery_time
+            ):
+                self.rejected += 1
+                return False
+            if self.probes >= self.half_open_probes:
+                self.probes = 0
+            if self.probes == 0:
+                self.opened_at = time.monotonic()
+            self.probes += 1
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(self.OPEN)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "transitions": dict(self.transitions),
+        }
+
+
+class FilterMetrics:
+    """过滤器自身热路径的指标（Prometheus 风格的直方图和计数器），关闭时记录调用直接返回"""
+
+    # 延迟直方图的桶上界（秒）
+    LATENCY_BUCKETS = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+    # 请求体大小直方图的桶上界（字节）
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.instance = uuid.uuid4().hex[:12]
+        self._counters: dict = {}
+        self._histograms: dict = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = {
+                "buckets": buckets,
+                "counts": [0] * (len(buckets) + 1),
+                "sum": 0.0,
+            }
+        histogram["counts"][bisect.bisect_left(buckets, value)] += 1
+        histogram["sum"] += value
+
+    def snapshot(self, counters: dict, gauges: dict) -> dict:
+        """生成推送给监控服务的快照；counters/gauges 为调用方附带的缓存和熔断器统计"""
+        histograms = []
+        for (name, labels), histogram in self._histograms.items():
+            cumulative, total = [], 0
+            for count in histogram["counts"]:
+                total += count
+                cumulative.append(total)
+            histograms.append(
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": list(histogram["buckets"]),
+                    "counts": cumulative[:-1],
+                    "count": total,
+                    "sum": histogram["sum"],
+                }
+            )
+
+        return {
+            "instance": self.instance,
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+            + [
+                {"name": name, "labels": {}, "value": value}
+                for name, value in counters.items()
+            ],
+            "gauges": [
+                {"name": name, "labels": {}, "value": value}
+                for name, value in gauges.items()
+            ],
+            "histograms": histograms,
+        }
+
+
+class StateBackend:
+    """余额、预留和请求上下文的共享状态后端
+
+    值为可 JSON 序列化的对象；所有后端的 TTL 语义一致：set 之后 ttl 秒过期，
+    过期的值不会被读到，ttl <= 0 等同于删除，incr 只修改值并保留剩余 TTL。
+    hset/hdel/hvalues 操作键下的字段，每个字段单独过期，多个 worker 同时写不同字段互不覆盖。
+    后端出错（文件被锁、Redis 不可用等）时按未命中处理，不影响对话。
+    """
+
+    errors: tuple = ()
+    # 会阻塞的后端（文件、网络）通过 run 在线程中调用，不占用事件循环
+    blocking = True
+
+    def __init__(self):
+        self._warned_at = 0.0
+
+    def _warn(self, error: Exception):
+        now = time.monotonic()
+        if now - self._warned_at >= 60:
+            self._warned_at = now
+            print(f"OpenWebUI Monitor: 共享状态后端 {type(self).__name__} 出错: {error}")
+
+    async def run(self, name: str, *args) -> Any:
+        """在事件循环中调用后端操作：阻塞的后端放到线程中执行"""
+        method = getattr(self, name)
+        if not self.blocking:
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+    def get(self, key: str) -> Any:
+        try:
+            return self._get(key)
+        except self.errors as e:
+            self._warn(e)
+            return None
+
+    def set(self, key: str, value: Any, ttl: float):
+        try:
+            if ttl > 0:
+                self._set(key, value, ttl)
+            else:
+                self._delete(key)
+        except self.errors as e:
+            self._warn(e)
+
+    def incr(self, key: str, amount: float) -> Optional[float]:
+        """键存在且未过期时原子地加上 amount 并保留剩余 TTL，返回新值；键不存在时不创建"""
+        try:
+            return self._incr(key, amount)
+        except self.errors as e:
+            self._warn(e)
+            return None
+
+    def pop(self, key: str) -> Any:
+        try:
+            return self._pop(key)
+        except self.errors as e:
+            self._warn(e)
+            return None
+
+    def delete(self, key: str):
+        try:
+            self._delete(key)
+        except self.errors as e:
+            self._warn(e)
+
+    def hset(self, key: str, field: str, value: Any, ttl: float):
+        """写入键下的一个字段，字段 ttl 秒后过期"""
+        try:
+            self._hset(key, field, value, ttl)
+        except self.errors as e:
+            self._warn(e)
+
+    def hdel(self, key: str, field: str):
+        try:
+            self._hdel(key, field)
+        except self.errors as e:
+            self._warn(e)
+
+    def hvalues(self, key: str) -> list:
+        """键下所有未过期字段的值"""
+        try:
+            return self._hvalues(key)
+        except self.errors as e:
+            self._warn(e)
+            return []
+
+
+class MemoryStateBackend(StateBackend):
+    """进程内状态（默认），只在当前 worker 内有效，值不经过序列化"""
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 20000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _live(self, key: str) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def _get(self, key: str) -> Any:
+        entry = self._live(key)
+        return None if entry is None else entry[1]
+
+    def _set(self, key: str, value: Any, ttl: float):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _incr(self, key: str, amount: float) -> Optional[float]:
+        entry = self._live(key)
+        if entry is None:
+            return None
+        value = entry[1] + amount
+        self._entries[key] = (entry[0], value)
+        return value
+
+    def _pop(self, key: str) -> Any:
+        entry = self._live(key)
+        if entry is None:
+            return None
+        del self._entries[key]
+        return entry[1]
+
+    def _delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def _fields(self, key: str) -> dict:
+        """键下未过期的字段 {字段: (过期时间, 值)}，顺带剔除已过期的字段"""
+        entry = self._live(key)
+        if entry is None:
+            return {}
+        now = time.monotonic()
+        fields = entry[1]
+        for field in [field for field, (expires_at, _) in fields.items() if expires_at <= now]:
+            del fields[field]
+        return fields
+
+    def _hset(self, key: str, field: str, value: Any, ttl: float):
+        now = time.monotonic()
+        fields = self._fields(key)
+        fields[field] = (now + ttl, value)
+        self._set(key, fields, max(expires_at for expires_at, _ in fields.values()) - now)
+
+    def _hdel(self, key: str, field: str):
+        self._fields(key).pop(field, None)
+
+    def _hvalues(self, key: str) -> list:
+        return [value for _, value in self._fields(key).values()]
+
+
+class SQLiteStateBackend(StateBackend):
+    """SQLite（WAL 模式）文件中的共享状态，同一主机上的多个 worker 进程共用一个文件"""
+
+    errors = (sqlite3.Error, OSError)
+    # 清理过期键的最小间隔（秒）
+    purge_interval = 60
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._purged_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # 自动提交：每条语句单独成事务，避免跨进程长时间持有写锁
+            conn = sqlite3.connect(
+                self.path, timeout=5.0, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS shared_fields (
+                    key TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (key, field)
+                ) WITHOUT ROWID"""
+            )
+            self._conn = conn
+        return self._conn
+
+    def _purge(self, conn: sqlite3.Connection, now: float):
+        if now - self._purged_at >= self.purge_interval:
+            self._purged_at = now
+            conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM shared_fields WHERE expires_at <= ?", (now,))
+
+    def _get(self, key: str) -> Any:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM shared_state WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _set(self, key: str, value: Any, ttl: float):
+        # 跨进程只能比较墙上时间，过期时间按 time.time() 记录
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, separators=(",", ":")), now + ttl),
+            )
+            self._purge(conn, now)
+
+    def _incr(self, key: str, amount: float) -> Optional[float]:
+        # 单条 UPDATE 在数据库内完成读改写，多个进程同时扣减不会互相覆盖
+        with self._lock:
+            row = self._connect().execute(
+                """UPDATE shared_state SET value = CAST(CAST(value AS REAL) + ? AS TEXT)
+                   WHERE key = ? AND expires_at > ?
+                   RETURNING value""",
+                (amount, key, time.time()),
+            ).fetchone()
+        return None if row is None else float(row[0])
+
+    def _pop(self, key: str) -> Any:
+        # DELETE ... RETURNING 保证多个 worker 同时取同一个键时只有一个能拿到
+        with self._lock:
+            rows = self._connect().execute(
+                "DELETE FROM shared_state WHERE key = ? RETURNING value, expires_at",
+                (key,),
+            ).fetchall()
+        if not rows or rows[0][1] <= time.time():
+            return None
+        return json.loads(rows[0][0])
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._connect().execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def _hset(self, key: str, field: str, value: Any, ttl: float):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_fields (key, field, value, expires_at) VALUES (?, ?, ?, ?)",
+                (key, field, json.dumps(value, separators=(",", ":")), now + ttl),
+            )
+            self._purge(conn, now)
+
+    def _hdel(self, key: str, field: str):
+        with self._lock:
+            self._connect().execute(
+                "DELETE FROM shared_fields WHERE key = ? AND field = ?", (key, field)
+            )
+
+    def _hvalues(self, key: str) -> list:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT value FROM shared_fields WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class RedisStateBackend(StateBackend):
+    """Redis 协议的共享状态（Redis、Valkey、KeyDB、Dragonfly 等均可），需要安装 redis 包"""
+
+    prefix = "openwebui_monitor:"
+    # 只修改已存在的键：INCRBYFLOAT 本身保留 TTL，但会创建不存在的键（且不带 TTL）
+    INCR_EXISTING = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+        end
+        return false
+    """
+    # 写入字段，并把整个键的 TTL 延长到不短于该字段的过期时间
+    HSET_EXTEND = """
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[3]) then
+            redis.call('PEXPIRE', KEYS[1], ARGV[3])
+        end
+        return 1
+    """
+
+    def __init__(self, url: str):
+        import redis
+
+        super().__init__()
+        self.url = url
+        self.errors = (redis.RedisError, OSError)
+        # 只连接本机或同机房的实例，超时设短；调用在线程中执行，不会阻塞事件循环
+        self._client = redis.Redis.from_url(
+            url, socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+        self._incr_existing = self._client.register_script(self.INCR_EXISTING)
+        self._hset_extend = self._client.register_script(self.HSET_EXTEND)
+
+    def _get(self, key: str) -> Any:
+        raw = self._client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def _set(self, key: str, value: Any, ttl: float):
+        self._client.set(
+            self.prefix + key,
+            json.dumps(value, separators=(",", ":")),
+            px=max(1, int(ttl * 1000)),
+        )
+
+    def _incr(self, key: str, amount: float) -> Optional[float]:
+        raw = self._incr_existing(keys=[self.prefix + key], args=[amount])
+        return None if raw is None else float(raw)
+
+    def _pop(self, key: str) -> Any:
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        raw, _ = pipe.execute()
+        return None if raw is None else json.loads(raw)
+
+    def _delete(self, key: str):
+        self._client.delete(self.prefix + key)
+
+    def _hset(self, key: str, field: str, value: Any, ttl: float):
+        # 哈希字段没有独立的 TTL，过期时间（墙上时间）与值一起保存
+        ttl_ms = max(1, int(ttl * 1000))
+        self._hset_extend(
+            keys=[self.prefix + key],
+            args=[field, json.dumps([time.time() + ttl, value], separators=(",", ":")), ttl_ms],
+        )
+
+    def _hdel(self, key: str, field: str):
+        self._client.hdel(self.prefix + key, field)
+
+    def _hvalues(self, key: str) -> list:
+        now = time.time()
+        values, expired = [], []
+        for field, raw in self._client.hgetall(self.prefix + key).items():
+            expires_at, value = json.loads(raw)
+            if expires_at > now:
+                values.append(value)
+            else:
+                expired.append(field)
+        if expired:
+            self._client.hdel(self.prefix + key, *expired)
+        return values
+
+
+def create_state_backend(kind: str, path: str, url: str) -> StateBackend:
+    """按 valves 创建共享状态后端：memory（默认）、sqlite 或 redis"""
+    kind = (kind or "memory").lower()
+    if kind == "sqlite":
+        return SQLiteStateBackend(path)
+    if kind == "redis":
+        try:
+            return RedisStateBackend(url)
+        except ImportError:
+            print("OpenWebUI Monitor: 未安装 redis 包，共享状态改用进程内存储")
+    return MemoryStateBackend()
+
+
+class RequestContextStore:
+    """按 chat_id/message_id 隔离的请求上下文，带 TTL 过期和容量上限
+
+    inlet 和 stream 在同一个请求内执行，上下文先保存在本进程；配置了共享状态后端时
+    同时写入后端，outlet 落到其他 worker 上也能取到计时和预留信息。
+    """
+
+    # stream 中向共享后端同步计时的最小间隔（秒）
+    sync_interval = 0.5
+
+    def __init__(
+        self,
+        ttl: float = 3600,
+        max_entries: int = 10000,
+        backend: Optional[StateBackend] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # stream 中发起的后台同步任务，保存引用避免任务被回收
+        self._syncing: set = set()
+
+    @staticmethod
+    def make_key(body: dict, metadata: Optional[dict], user: Optional[dict]) -> str:
+        """inlet 从 __metadata__ 取 ID，outlet 的 body 中带有 chat_id 和消息 id"""
+        metadata = metadata or {}
+        chat_id = metadata.get("chat_id") or body.get("chat_id")
+        message_id = metadata.get("message_id") or body.get("id")
+        if chat_id or message_id:
+            return f"{chat_id}:{message_id}"
+        return f"user:{(user or {}).get('id')}"
+
+    def _evict(self, now: float):
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    async def put(self, key: str, context: dict):
+        now = time.monotonic()
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, context)
+        self._evict(now)
+        await self.share(key, context)
+
+    async def share(self, key: str, context: dict):
+        """把上下文写入共享后端（单进程部署时无操作）"""
+        if self.backend is not None:
+            context["synced_at"] = time.monotonic()
+            # 在事件循环中复制一份，stream 修改上下文时不影响线程中的序列化
+            await self.backend.run("set", f"context:{key}", dict(context), self.ttl)
+
+    def touch(self, key: str, context: dict):
+        """stream 更新计时后调用：首 token 立即同步，之后按 sync_interval 节流，在后台写入"""
+        if self.backend is None or not (
+            context.get("chunks") == 1
+            or time.monotonic() - context.get("synced_at", 0) >= self.sync_interval
+        ):
+            return
+        context["synced_at"] = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（同步调用 stream）时直接写入
+            self.backend.set(f"context:{key}", dict(context), self.ttl)
+            return
+        task = loop.create_task(self._sync(key, context))
+        self._syncing.add(task)
+        task.add_done_callback(self._syncing.discard)
+
+    async def _sync(self, key: str, context: dict):
+        # outlet 已取走上下文时不再写回，避免留下过期前无人读取的副本
+        if key in self._entries:
+            await self.share(key, context)
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def pop(self, key: str) -> Optional[dict]:
+        entry = self._entries.pop(key, None)
+        shared = (
+            await self.backend.run("pop", f"context:{key}")
+            if self.backend is not None
+            else None
+        )
+        if entry is None or entry[0] <= time.monotonic():
+            # inlet 在其他 worker 上执行；共享副本中的最后 token 时间最多滞后 sync_interval
+            return shared
+        return entry[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class BalanceCache:
+    """用户余额的缓存，余额充足且未过期时 inlet 无需请求监控服务
+
+    余额和预留都存放在共享状态后端中，多个 worker 看到的是同一份数据：
+    每个进行中请求的预留是 reservation:{用户} 下的一个字段，读取时求和；扣减余额在后端原子完成。
+    """
+
+    def __init__(self, ttl: float = 60, backend: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.backend = backend or MemoryStateBackend()
+        self.hits = 0
+        self.misses = 0
+
+    async def lookup(
+        self, user_id: Optional[str], margin: float, estimate: float = 0.0
+    ) -> Optional[float]:
+        """返回扣除预留和本次预估费用后仍可直接放行的缓存余额；过期、缺失或不足时返回 None"""
+        if user_id:
+            balance, reserved = await asyncio.gather(
+                self.backend.run("get", f"balance:{user_id}"), self.reserved(user_id)
+            )
+        else:
+            balance, reserved = None, 0.0
+        if balance is None or balance - reserved - estimate <= margin:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return balance
+
+    async def reserved(self, user_id: Optional[str]) -> float:
+        if not user_id:
+            return 0.0
+        return sum(await self.backend.run("hvalues", f"reservation:{user_id}"))
+
+    async def reserve(self, user_id: Optional[str], key: str, amount: float, ttl: float):
+        if user_id and amount > 0:
+            await self.backend.run("hset", f"reservation:{user_id}", key, amount, ttl)
+
+    async def release(self, user_id: Optional[str], key: str):
+        if user_id:
+            await self.backend.run("hdel", f"reservation:{user_id}", key)
+
+    async def debit(self, user_id: Optional[str], amount: float):
+        """费用尚未由监控服务确认（写后计费）时先从缓存余额中扣除，不延长缓存时间"""
+        if user_id and amount:
+            await self.backend.run("incr", f"balance:{user_id}", -amount)
+
+    async def update(self, user_id: Optional[str], balance: float):
+        if not user_id or self.ttl <= 0:
+            return
+        await self.backend.run("set", f"balance:{user_id}", float(balance), self.ttl)
+
+    async def invalidate(self, user_id: Optional[str]):
+        if user_id:
+            await self.backend.run("delete", f"balance:{user_id}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "backend": type(self.backend).__name__,
+        }
+
+
+class SeenMessages:
+    """已计费的 assistant 消息 ID，outlet 据此跳过重复调用（重新生成、编辑、超时重试）
+
+    最近的 window 条精确记录；更早的记录在两代轮换的布隆过滤器中，当前代写满 capacity 条后
+    丢弃旧的一代，内存固定。布隆过滤器的误判（把未计费的消息当成已计费）概率约为
+    false_positive_rate。只在本 worker 内有效，跨 worker 的重复由监控服务按 message_id 去重。
+    """
+
+    def __init__(
+        self,
+        window: int = 4096,
+        capacity: int = 100000,
+        false_positive_rate: float = 1e-6,
+    ):
+        self.window = window
+        self.duplicates = 0
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._inflight: set = set()
+        self._params: Optional[tuple] = None
+        self.configure(capacity, false_positive_rate)
+
+    def configure(self, capacity: int, false_positive_rate: float):
+        """按容量和误判率计算位数与哈希个数；参数变化时清空布隆过滤器"""
+        capacity = max(1, capacity)
+        false_positive_rate = min(max(false_positive_rate, 1e-12), 0.5)
+        if self._params == (capacity, false_positive_rate):
+            return
+        self._params = (capacity, false_positive_rate)
+        self._capacity = capacity
+        # 查询同时检查两代，每一代按一半的误判率分配位数
+        self._bits = max(
+            64, int(-capacity * math.log(false_positive_rate / 2) / math.log(2) ** 2)
+        )
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        self._generations = [bytearray((self._bits + 7) // 8) for _ in range(2)]
+        self._count = 0
+
+    def _positions(self, message_id: str) -> list:
+        # 双重哈希：一次 blake2b 派生出全部位置
+        digest = hashlib.blake2b(message_id.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self._bits for i in range(self._hashes)]
+
+    def __contains__(self, message_id: str) -> bool:
+        if message_id in self._recent or message_id in self._inflight:
+            return True
+        positions = self._positions(message_id)
+        return any(
+            all(generation[p >> 3] & (1 << (p & 7)) for p in positions)
+            for generation in self._generations
+        )
+
+    def claim(self, message_id: str) -> bool:
+        """开始计费一条消息；已计费或正在计费时返回 False"""
+        if message_id in self:
+            self.duplicates += 1
+            return False
+        self._inflight.add(message_id)
+        return True
+
+    def confirm(self, message_id: Optional[str]):
+        """计费成功（或已写入本地队列）后记为已计费；没有消息 ID 时无法去重"""
+        if not message_id:
+            return
+        self._inflight.discard(message_id)
+        self._recent[message_id] = None
+        self._recent.move_to_end(message_id)
+        while len(self._recent) > self.window:
+            self._recent.popitem(last=False)
+
+        if self._count >= self._capacity:
+            self._generations = [bytearray(len(self._generations[0])), self._generations[0]]
+            self._count = 0
+        current = self._generations[0]
+        for p in self._positions(message_id):
+            current[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+
+    def release(self, message_id: str):
+        """计费未完成时释放，之后的重试可以再次计费；已确认的消息不受影响"""
+        self._inflight.discard(message_id)
+
+
+class RateLimiter:
+    """按用户、模型分别限流的令牌桶，桶容量为每分钟配额并按秒匀速补充
+
+    检查和扣减都是 O(1)；空闲超过一分钟的桶已经补满，与不存在等价，按最近使用顺序从头部淘汰。
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.throttled = 0
+        # key -> [剩余令牌, 上次更新时间]
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._buckets:
+            _, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < 60 and len(self._buckets) <= self.max_entries:
+                break
+            self._buckets.popitem(last=False)
+
+    def _level(self, key: tuple, per_minute: float, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return per_minute
+        return min(per_minute, bucket[0] + (now - bucket[1]) * per_minute / 60)
+
+    def acquire(self, limits: list) -> Optional[tuple]:
+        """limits 为 [(key, 每分钟配额, 本次消耗)]，配额 <= 0 表示不限
+
+        全部满足时一起扣减并返回 None；否则不扣减任何桶，返回 (key, 配额, 需等待的秒数)。
+        """
+        now = time.monotonic()
+        levels = []
+        for key, per_minute, amount in limits:
+            if per_minute <= 0:
+                continue
+            # 单次消耗超过配额时（例如超长上下文）按满桶放行，否则永远无法通过
+            amount = min(amount, per_minute)
+            level = self._level(key, per_minute, now)
+            if level < amount:
+                self.throttled += 1
+                return key, per_minute, (amount - level) * 60 / per_minute
+            levels.append((key, level - amount))
+
+        for key, level in levels:
+            self._buckets.pop(key, None)
+            self._buckets[key] = [level, now]
+        self._evict(now)
+        return None
+
+
+class ModelHealth:
+    """按模型被动统计真实请求的成功/失败、完成耗时和输出速度，无需向模型发送测试请求
+
+    最近 window 秒按 slot_seconds 分槽，每槽只保存计数和固定分桶的直方图，内存与请求量无关；
+    直方图在服务端可以跨实例直接相加后再求分位数。
+    """
+
+    LATENCY_BUCKETS = (0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120, 180, 300)
+    TPS_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 300)
+
+    def __init__(self, window: float = 300, slot_seconds: float = 10):
+        self.window = window
+        self.slot_seconds = slot_seconds
+        # model -> OrderedDict{槽序号: 槽}
+        self._models: dict = {}
+
+    def _expire(self, slots: OrderedDict, now: float):
+        oldest = int((now - self.window) // self.slot_seconds)
+        while slots and next(iter(slots)) <= oldest:
+            slots.popitem(last=False)
+
+    def _slot(self, model: str, now: float) -> dict:
+        slots = self._models.setdefault(model, OrderedDict())
+        index = int(now // self.slot_seconds)
+        slot = slots.get(index)
+        if slot is None:
+            self._expire(slots, now)
+            slot = slots[index] = {
+                "success": 0,
+                "failure": 0,
+                "latency": [0] * (len(self.LATENCY_BUCKETS) + 1),
+                "latency_sum": 0.0,
+                "tps": [0] * (len(self.TPS_BUCKETS) + 1),
+                "tps_sum": 0.0,
+            }
+        return slot
+
+    def record(
+        self,
+        model: Optional[str],
+        success: bool,
+        latency: Optional[float] = None,
+        tokens_per_sec: Optional[float] = None,
+    ):
+        if not model:
+            return
+        slot = self._slot(model, time.time())
+        slot["success" if success else "failure"] += 1
+        if latency is not None:
+            slot["latency"][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+            slot["latency_sum"] += latency
+        if tokens_per_sec is not None:
+            slot["tps"][bisect.bisect_left(self.TPS_BUCKETS, tokens_per_sec)] += 1
+            slot["tps_sum"] += tokens_per_sec
+
+    def summary(self) -> list:
+        """合并窗口内各槽，返回每个模型的计数和直方图（counts 最后一项为超出最大分桶的样本）"""
+        now = time.time()
+        models = []
+        for model in list(self._models):
+            slots = self._models[model]
+            self._expire(slots, now)
+            if not slots:
+                del self._models[model]
+                continue
+            merged = {
+                "model": model,
+                "success": 0,
+                "failure": 0,
+                "latency": {
+                    "buckets": list(self.LATENCY_BUCKETS),
+                    "counts": [0] * (len(self.LATENCY_BUCKETS) + 1),
+                    "sum": 0.0,
+                },
+                "tokens_per_sec": {
+                    "buckets": list(self.TPS_BUCKETS),
+                    "counts": [0] * (len(self.TPS_BUCKETS) + 1),
+                    "sum": 0.0,
+                },
+            }
+            for slot in slots.values():
+                merged["success"] += slot["success"]
+                merged["failure"] += slot["failure"]
+                for name, key in (("latency", "latency"), ("tokens_per_sec", "tps")):
+                    histogram = merged[name]
+                    histogram["sum"] += slot[f"{key}_sum"]
+                    for i, count in enumerate(slot[key]):
+                        histogram["counts"][i] += count
+            models.append(merged)
+        return models
+
+
+class UsageRollups:
+    """按 (小时, 用户, 模型) 累加已计费的使用量，定期整批上报给监控服务，面板无需扫描原始记录
+
+    待上报的批次在确认前保留同一个 batch_id，重试时服务端按 batch_id 去重，不会重复累加；
+    丢失或迟到的增量会在该小时结算时由服务端从原始记录修正。
+    """
+
+    BUCKET_SECONDS = 3600
+
+    def __init__(self, max_rows: int = 5000):
+        self.max_rows = max_rows
+        self._rows: dict = {}
+        self._pending: Optional[dict] = None
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._rows) + (len(self._pending["rollups"]) if self._pending else 0)
+
+    def add(
+        self,
+        user_id: Optional[str],
+        nickname: Optional[str],
+        model: Optional[str],
+        input_tokens: int,
+        output_tokens: int,
+        cost: float,
+    ):
+        if not user_id or not model:
+            return
+        bucket = int(time.time() // self.BUCKET_SECONDS * self.BUCKET_SECONDS)
+        key = (bucket, user_id, model)
+        row = self._rows.get(key)
+        if row is None:
+            if len(self._rows) >= self.max_rows:
+                # 积压过多时丢弃新的增量，由服务端结算时补齐
+                self.dropped += 1
+                return
+            row = self._rows[key] = {
+                "bucket": bucket,
+                "user_id": user_id,
+                "nickname": nickname,
+                "model": model,
+                "requests": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cost": 0.0,
+            }
+        row["nickname"] = nickname or row["nickname"]
+        row["requests"] += 1
+        row["input_tokens"] += int(input_tokens or 0)
+        row["output_tokens"] += int(output_tokens or 0)
+        row["cost"] += float(cost or 0)
+
+    def next_batch(self) -> Optional[dict]:
+        """返回待上报的批次；上一批未确认时原样返回以便重试"""
+        if self._pending is None and self._rows:
+            self._pending = {
+                "batch_id": uuid.uuid4().hex,
+                "rollups": list(self._rows.values()),
+            }
+            self._rows = {}
+        return self._pending
+
+    def ack(self):
+        self._pending = None
+
+
+class PriceCache:
+    """本地缓存的模型价格（每百万 token），用于 inlet 预估和 outlet 预先计算费用
+
+    后台定期刷新：带 ETag 询问价格是否变化，变化时只拉取上次同步之后更新的价格。
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.prices: dict = {}
+        self.default: Optional[tuple] = None
+        self.fetched_at: Optional[float] = None
+        self.etag: Optional[str] = None
+        self.updated_at: Optional[str] = None
+
+    @staticmethod
+    def _parse(item: dict) -> tuple:
+        per_msg_price = item.get("per_msg_price")
+        return (
+            float(item["input_price"]),
+            float(item["output_price"]),
+            float(-1 if per_msg_price is None else per_msg_price),
+        )
+
+    def stale(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl
+
+    def request_headers(self) -> tuple:
+        """返回下次刷新使用的查询参数和请求头"""
+        params = {"since": self.updated_at} if self.updated_at else {}
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        return params, headers
+
+    def not_modified(self):
+        self.fetched_at = time.monotonic()
+
+    def load(self, data: dict, etag: Optional[str] = None):
+        prices = {item["id"]: self._parse(item) for item in data.get("prices", [])}
+        if data.get("full", True):
+            self.prices = prices
+        else:
+            self.prices.update(prices)
+        self.default = self._parse(data["default"]) if data.get("default") else None
+        self.fetched_at = time.monotonic()
+
+        if data.get("count") is not None and data["count"] != len(self.prices):
+            # 服务端有价格被删除，增量结果无法反映，下次改为全量拉取
+            self.etag = self.updated_at = None
+            self.fetched_at = None
+        else:
+            self.etag = etag
+            self.updated_at = data.get("updated_at")
+
+    def get(self, model: Optional[str]) -> Optional[tuple]:
+        return self.prices.get(model, self.default)
+
+    @staticmethod
+    def cost(price: tuple, input_tokens: int, output_tokens: int) -> float:
+        """与监控服务相同的计费规则：设置了按次价格时按次计费，否则按 token 计费"""
+        input_price, output_price, per_msg_price = price
+        if per_msg_price >= 0:
+            return per_msg_price
+        return (input_tokens / 1_000_000) * input_price + (
+            output_tokens / 1_000_000
+        ) * output_price
+
+
+class OutletSpool:
+    """基于 SQLite 的本地 outlet 事件队列（写后计费），监控服务重启或不可用时事件不会丢失"""
+
+    # 单条事件被服务端拒绝的最大次数，超过后丢弃以免阻塞队列
+    max_attempts = 10
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._size = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS outlet_events (
+                    id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            conn.commit()
+            self._size = conn.execute("SELECT COUNT(*) FROM outlet_events").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def append(self, event_id: str, payload: bytes, max_events: int) -> bool:
+        """写入一条事件；队列已满时返回 False，由调用方改为同步发送"""
+        with self._lock:
+            conn = self._connect()
+            if self._size >= max_events:
+                return False
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO outlet_events (id, payload, created_at) VALUES (?, ?, ?)",
+                (event_id, payload, time.time()),
+            )
+            conn.commit()
+            self._size += cursor.rowcount
+            return True
+
+    def peek(self, limit: int) -> list:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, payload FROM outlet_events ORDER BY created_at LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+    def ack(self, event_ids: list):
+        if not event_ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            placeholders = ",".join("?" * len(event_ids))
+            cursor = conn.execute(
+                f"DELETE FROM outlet_events WHERE id IN ({placeholders})", event_ids
+            )
+            conn.commit()
+            self._size -= cursor.rowcount
+
+    def fail(self, event_ids: list) -> list:
+        """记录一次失败，返回因超过重试次数而被丢弃的事件 ID"""
+        if not event_ids:
+            return []
+        with self._lock:
+            conn = self._connect()
+            placeholders = ",".join("?" * len(event_ids))
+            conn.execute(
+                f"UPDATE outlet_events SET attempts = attempts + 1 WHERE id IN ({placeholders})",
+                event_ids,
+            )
+            dropped = [
+                row[0]
+                for row in conn.execute(
+                    f"SELECT id FROM outlet_events WHERE attempts >= ? AND id IN ({placeholders})",
+                    [self.max_attempts, *event_ids],
+                )
+            ]
+            if dropped:
+                cursor = conn.execute(
+                    f"DELETE FROM outlet_events WHERE id IN ({','.join('?' * len(dropped))})",
+                    dropped,
+                )
+                self._size -= cursor.rowcount
+            conn.commit()
+            return dropped
+
+    def __len__(self) -> int:
+        return self._size
+
+
 class Filter:
     class Valves(BaseModel):
         API_ENDPOINT: str = Field(
@@ -40,6 +1635,118 @@ class Filter:
         priority: int = Field(
             default=5, description="Priority level for the filter operations."
         )
+        context_ttl: int = Field(
+            default=3600,
+            description="Seconds to keep per-request timing state between inlet and outlet",
+        )
+        max_contexts: int = Field(
+            default=10000,
+            description="Maximum number of in-flight request contexts kept in memory",
+        )
+        state_backend: str = Field(
+            default="memory",
+            description="Where balances, reservations and request timings are shared: memory (this worker only), sqlite (one file for all workers on the host) or redis",
+        )
+        state_path: str = Field(
+            default="/app/backend/data/openwebui_monitor_state.db",
+            description="SQLite file used when state_backend is sqlite",
+        )
+        state_url: str = Field(
+            default="redis://localhost:6379/0",
+            description="Redis-compatible server URL used when state_backend is redis (requires the redis package)",
+        )
+        balance_cache_ttl: int = Field(
+            default=60,
+            description="Seconds a cached user balance lets inlet skip the monitor (0 disables)",
+        )
+        balance_safety_margin: float = Field(
+            default=1.0,
+            description="Users whose cached balance is at or below this always check with the monitor",
+        )
+        budget_check: bool = Field(
+            default=True,
+            description="Estimate each request's cost in inlet and reserve it against the cached balance",
+        )
+        max_generation_time: int = Field(
+            default=600,
+            description="Longest expected generation in seconds; a cost reservation whose outlet never arrives (aborted chat, lost worker) is dropped after this plus read_timeout",
+        )
+        budget_output_tokens: int = Field(
+            default=1024,
+            description="Output tokens reserved for requests that do not set max_tokens",
+        )
+        dedupe_outlet: bool = Field(
+            default=True,
+            description="Skip outlet billing for assistant messages this worker has already billed",
+        )
+        dedupe_window: int = Field(
+            default=4096,
+            description="Most recent billed message ids remembered exactly",
+        )
+        dedupe_capacity: int = Field(
+            default=100000,
+            description="Message ids per generation of the rotating Bloom filter that covers older messages",
+        )
+        dedupe_false_positive_rate: float = Field(
+            default=1e-6,
+            description="Bloom filter false positive rate (chance an unbilled message is taken as billed)",
+        )
+        rate_limit_enabled: bool = Field(
+            default=False,
+            description="Throttle requests in inlet with local per-user and per-model token buckets",
+        )
+        user_requests_per_minute: int = Field(
+            default=0, description="Requests per minute allowed for each user (0 = unlimited)"
+        )
+        user_tokens_per_minute: int = Field(
+            default=0,
+            description="Estimated input+output tokens per minute allowed for each user (0 = unlimited)",
+        )
+        model_requests_per_minute: int = Field(
+            default=0,
+            description="Requests per minute allowed for each model across all users (0 = unlimited)",
+        )
+        model_tokens_per_minute: int = Field(
+            default=0,
+            description="Estimated tokens per minute allowed for each model across all users (0 = unlimited)",
+        )
+        rate_limit_role_overrides: str = Field(
+            default="",
+            description='Per-role JSON overrides of the user limits, e.g. {"admin": {"user_requests_per_minute": 0}, "vip": {"user_tokens_per_minute": 200000}}',
+        )
+        price_refresh_interval: int = Field(
+            default=300, description="Seconds between background model price refreshes"
+        )
+        local_token_count: bool = Field(
+            default=True,
+            description="Count message tokens in the filter (tiktoken) instead of on the monitor server",
+        )
+        tokenizer_encoding: str = Field(
+            default="cl100k_base",
+            description="Fallback tiktoken encoding for models tiktoken does not know",
+        )
+        token_cache_size: int = Field(
+            default=10000,
+            description="Maximum number of cached per-message token counts",
+        )
+        write_behind: bool = Field(
+            default=False,
+            description="Queue outlet billing in a local spool and send it in batches in the background",
+        )
+        spool_path: str = Field(
+            default="/app/backend/data/openwebui_monitor_spool.db",
+            description="SQLite file used as the write-behind billing spool",
+        )
+        batch_size: int = Field(
+            default=50, description="Maximum billing events per batch request"
+        )
+        flush_interval: float = Field(
+            default=2.0, description="Seconds between background spool flushes"
+        )
+        max_spool_events: int = Field(
+            default=10000,
+            description="Spool size at which outlet falls back to synchronous billing",
+        )
         show_cost: bool = Field(default=True, description="Display cost information")
         show_balance: bool = Field(
             default=True, description="Display balance information"
@@ -50,48 +1757,764 @@ class Filter:
         )
         language: str = Field(
             default="en", 
-            description="Language for messages (en/zh)"
+            description="Language for messages (en/zh/ja/ko/fr/de/es)"
+        )
+        status_template: str = Field(
+            default="",
+            description="Custom status line, segments separated by | (fields: cost, balance, input, output, time, ttft, tokens_per_sec)",
+        )
+        http2: bool = Field(
+            default=False,
+            description="Use HTTP/2 for monitor requests (requires the h2 package)",
+        )
+        max_connections: int = Field(
+            default=100,
+            description="Maximum pooled connections to the monitor server",
+        )
+        connect_timeout: float = Field(
+            default=3.0, description="Seconds to wait when connecting to the monitor"
+        )
+        read_timeout: float = Field(
+            default=10.0, description="Seconds to wait for a monitor response"
+        )
+        breaker_failure_threshold: int = Field(
+            default=5,
+            description="Consecutive monitor failures that open the circuit breaker",
+        )
+        breaker_recovery_time: float = Field(
+            default=30.0,
+            description="Seconds the breaker stays open before probing the monitor again",
+        )
+        breaker_half_open_probes: int = Field(
+            default=1, description="Probe requests allowed while the breaker is half-open"
+        )
+        fail_open: bool = Field(
+            default=False,
+            description="Let chats through when the monitor is unavailable. Their charges are queued in the local spool and billed on recovery, but balances are not checked meanwhile, so users can go negative (off blocks chats, as before)",
+        )
+        compression: str = Field(
+            default="gzip",
+            description="Compress large monitor request bodies: gzip, zstd (requires zstandard) or none",
+        )
+        compression_threshold: int = Field(
+            default=8192, description="Minimum request body size in bytes to compress"
+        )
+        fast_json: bool = Field(
+            default=True,
+            description="Serialize monitor payloads with orjson/msgspec when installed (falls back to json)",
+        )
+        metrics_enabled: bool = Field(
+            default=False,
+            description="Record filter latency/size histograms and push them to /api/v1/metrics",
+        )
+        metrics_push_interval: float = Field(
+            default=15.0, description="Seconds between metrics pushes to the monitor"
+        )
+        model_health_enabled: bool = Field(
+            default=True,
+            description="Push per-model success rate, completion time and tokens/sec from real traffic to the models page",
+        )
+        model_health_window: int = Field(
+            default=300, description="Seconds of recent traffic covered by model health"
+        )
+        model_health_push_interval: float = Field(
+            default=30.0, description="Seconds between model health pushes to the monitor"
+        )
+        usage_rollups: bool = Field(
+            default=True,
+            description="Aggregate billed usage per user, model and hour and report it to the monitor so the panel reads pre-aggregated totals",
+        )
+        rollup_flush_interval: float = Field(
+            default=10.0, description="Seconds between usage rollup reports to the monitor"
+        )
+
+    class UserValves(BaseModel):
+        status_template: str = Field(
+            default="",
+            description="Custom status line for this user, e.g. '{cost:.4f} | {tokens_per_sec:.1f} T/s'",
         )
 
     def __init__(self):
         self.type = "filter"
         self.name = "OpenWebUI Monitor"
         self.valves = self.Valves()
-        self.outage = False
-        self.start_time = None
+        self.contexts = RequestContextStore(
+            self.valves.context_ttl, self.valves.max_contexts
+        )
+        self.balances = BalanceCache(self.valves.balance_cache_ttl)
+        self.seen = SeenMessages(
+            self.valves.dedupe_window,
+            self.valves.dedupe_capacity,
+            self.valves.dedupe_false_positive_rate,
+        )
+        self.limiter = RateLimiter()
+        self._role_overrides_raw: Optional[str] = None
+        self._role_overrides: dict = {}
+        self._state_key: Optional[tuple] = None
+        self._sync_state_backend()
+        self.prices = PriceCache(self.valves.price_refresh_interval)
+        self._price_refresh: Optional[asyncio.Task] = None
+        self.breaker = CircuitBreaker(
+            self.valves.breaker_failure_threshold,
+            self.valves.breaker_recovery_time,
+            self.valves.breaker_half_open_probes,
+        )
+        self.tokens = TokenCounter(
+            self.valves.tokenizer_encoding, self.valves.token_cache_size
+        )
+        self.user_headers = UserHeaderCache()
+        self._rejected_encodings: set = set()
+        self.metrics = FilterMetrics(self.valves.metrics_enabled)
+        self._metrics_pusher: Optional[asyncio.Task] = None
+        self.health = ModelHealth(self.valves.model_health_window)
+        self._health_pusher: Optional[asyncio.Task] = None
+        # stream 等同步钩子中发起的后台任务，保存引用避免任务被回收
+        self._background: set = set()
+        self.rollups = UsageRollups()
+        self._rollup_flusher: Optional[asyncio.Task] = None
+        self._spool: Optional[OutletSpool] = None
+        self._flusher: Optional[asyncio.Task] = None
         self.translations = TRANSLATIONS
+        self._renderers: dict = {}
+
+    def _status_renderer(self, __user__: dict) -> StatusRenderer:
+        """按 valves 和用户模板缓存编译好的渲染器，valves 变化后自动重新编译"""
+        user_valves = __user__.get("valves")
+        user_template = getattr(user_valves, "status_template", None)
+        if user_template is None and isinstance(user_valves, dict):
+            user_template = user_valves.get("status_template")
+        template = user_template or self.valves.status_template
+
+        valves = self.valves
+        key = (
+            valves.language,
+            valves.show_cost,
+            valves.show_balance,
+            valves.show_tokens,
+            valves.show_tokens_per_sec,
+            template,
+        )
+        renderer = self._renderers.get(key)
+        if renderer is None:
+            if len(self._renderers) >= 64:
+                self._renderers.clear()
+            renderer = self._renderers[key] = StatusRenderer.compile(valves, template)
+        return renderer
 
     def get_text(self, key: str, **kwargs) -> str:
-        """获取指定语言的文本"""
-        lang = self.valves.language
-        if lang not in self.translations:
-            lang = "en"
-        text = self.translations[lang].get(key, self.translations["en"][key])
+        """获取指定语言的文本，与状态栏使用相同的语言解析（zh-CN 退回 zh）"""
+        text = resolve_translations(self.valves.language)[key]
         return text.format(**kwargs) if kwargs else text
 
-    def _prepare_user_dict(self, __user__: dict) -> dict:
-        """将 __user__ 对象转换为可序列化的字典"""
-        user_dict = dict(__user__)
-        if "valves" in user_dict and hasattr(user_dict["valves"], "model_dump"):
-            user_dict["valves"] = user_dict["valves"].model_dump()
-        
-        return user_dict
+    def _sync_state_backend(self):
+        """valves 中的共享状态配置变化后重新创建后端，余额缓存和请求上下文随之切换"""
+        valves = self.valves
+        key = (valves.state_backend, valves.state_path, valves.state_url)
+        if key == self._state_key:
+            return
+        self._state_key = key
+        backend = create_state_backend(*key)
+        self.balances.backend = backend
+        # 进程内后端无需为上下文再保存一份副本
+        self.contexts.backend = (
+            None if isinstance(backend, MemoryStateBackend) else backend
+        )
+
+    def _encode(self, data: Any) -> bytes:
+        return json_encoder(self.valves.fast_json)(data)
+
+    def _content_encoding(self, size: int) -> Optional[str]:
+        """请求体超过阈值时选择压缩格式；zstd 不可用或被服务端拒绝时退回 gzip"""
+        encoding = self.valves.compression.strip().lower()
+        if encoding not in ("gzip", "zstd") or size < self.valves.compression_threshold:
+            return None
+        if encoding == "zstd" and (
+            not zstd_available() or "zstd" in self._rejected_encodings
+        ):
+            encoding = "gzip"
+        return None if encoding in self._rejected_encodings else encoding
+
+    async def _post(self, path: str, data: Any) -> httpx.Response:
+        """通过共享连接池向监控服务发送请求，超时和 5xx 计入熔断器；data 可以是已编码的字节"""
+        self.breaker.failure_threshold = self.valves.breaker_failure_threshold
+        self.breaker.recovery_time = self.valves.breaker_recovery_time
+        self.breaker.half_open_probes = self.valves.breaker_half_open_probes
+        metrics = self.metrics
+        labels = (("path", path),)
+        if not self.breaker.allow():
+            metrics.inc("errors_total", labels + (("kind", "breaker_open"),))
+            raise MonitorUnavailableError(path)
+
+        started = time.perf_counter()
+        content = data if isinstance(data, bytes) else self._encode(data)
+        if metrics.enabled:
+            metrics.observe(
+                "serialize_seconds",
+                time.perf_counter() - started,
+                labels + (("stage", "json_encode"),),
+            )
+            metrics.observe(
+                "request_bytes", len(content), labels, FilterMetrics.SIZE_BUCKETS
+            )
+
+        headers = {
+            "Authorization": f"Bearer {self.valves.API_KEY}",
+            "Content-Type": "application/json",
+        }
+        body = content
+        encoding = self._content_encoding(len(content))
+        if encoding:
+            started = time.perf_counter()
+            if len(content) > COMPRESS_IN_THREAD_BYTES:
+                body = await asyncio.to_thread(compress_body, content, encoding)
+            else:
+                body = compress_body(content, encoding)
+            headers["Content-Encoding"] = encoding
+            metrics.observe(
+                "serialize_seconds",
+                time.perf_counter() - started,
+                labels + (("stage", "compress"),),
+            )
+        metrics.observe("wire_bytes", len(body), labels, FilterMetrics.SIZE_BUCKETS)
+
+        client = await get_http_client(self.valves.http2, self.valves.max_connections)
+        started = time.perf_counter()
+        try:
+            response = await client.post(
+                f"{self.valves.API_ENDPOINT}{path}",
+                headers=headers,
+                content=body,
+                timeout=httpx.Timeout(
+                    self.valves.read_timeout, connect=self.valves.connect_timeout
+                ),
+            )
+        except httpx.TransportError as e:
+            self.breaker.record_failure()
+            kind = "timeout" if isinstance(e, httpx.TimeoutException) else "transport"
+            metrics.inc("errors_total", labels + (("kind", kind),))
+            raise
+        finally:
+            metrics.observe("request_seconds", time.perf_counter() - started, labels)
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            metrics.inc("errors_total", labels + (("kind", "http_5xx"),))
+        else:
+            self.breaker.record_success()
+            if response.status_code >= 400:
+                metrics.inc("errors_total", labels + (("kind", "http_4xx"),))
+
+        if response.status_code == 415 and encoding:
+            # 监控服务不支持该压缩格式，之后不再使用并改为重发
+            self._rejected_encodings.add(encoding)
+            print(f"OpenWebUI Monitor: 监控服务不接受 {encoding} 压缩的请求")
+            return await self._post(path, content)
+        return response
+
+    def _metrics_snapshot(self) -> dict:
+        counters = {
+            "balance_cache_hits_total": self.balances.hits,
+            "balance_cache_misses_total": self.balances.misses,
+            "token_cache_hits_total": self.tokens.hits,
+            "token_cache_misses_total": self.tokens.misses,
+            "breaker_rejected_total": self.breaker.rejected,
+            "outlet_duplicates_skipped_total": self.seen.duplicates,
+            "rate_limited_total": self.limiter.throttled,
+            "breaker_opened_total": self.breaker.transitions[CircuitBreaker.OPEN],
+            "rollup_rows_dropped_total": self.rollups.dropped,
+        }
+        gauges = {
+            "inflight_contexts": len(self.contexts),
+            "breaker_open": int(self.breaker.state != CircuitBreaker.CLOSED),
+            "rollup_rows_pending": len(self.rollups),
+        }
+        if self._spool is not None:
+            gauges["spool_events"] = len(self._spool)
+        return self.metrics.snapshot(counters, gauges)
+
+    def _ensure_metrics_pusher(self):
+        self.metrics.enabled = self.valves.metrics_enabled
+        if self.metrics.enabled and (
+            self._metrics_pusher is None or self._metrics_pusher.done()
+        ):
+            self._metrics_pusher = asyncio.create_task(self._push_metrics())
+
+    async def _push_metrics(self):
+        """定期把指标快照推送到监控服务，关闭指标后退出；熔断器打开时跳过"""
+        while self.metrics.enabled:
+            await asyncio.sleep(max(1.0, self.valves.metrics_push_interval))
+            if self.breaker.state == CircuitBreaker.OPEN:
+                continue
+            try:
+                client = await get_http_client(
+                    self.valves.http2, self.valves.max_connections
+                )
+                await client.post(
+                    f"{self.valves.API_ENDPOINT}/api/v1/metrics",
+                    headers={"Authorization": f"Bearer {self.valves.API_KEY}"},
+                    json=self._metrics_snapshot(),
+                    timeout=httpx.Timeout(
+                        self.valves.read_timeout, connect=self.valves.connect_timeout
+                    ),
+                )
+            except Exception as e:
+                print(f"OpenWebUI Monitor: 推送指标失败: {e}")
+
+    def _ensure_health_pusher(self):
+        if self.valves.model_health_enabled and (
+            self._health_pusher is None or self._health_pusher.done()
+        ):
+            self._health_pusher = asyncio.create_task(self._push_health())
+
+    async def _push_health(self):
+        """定期把各模型的健康统计推送到监控服务，关闭后退出；没有流量或熔断器打开时跳过"""
+        while self.valves.model_health_enabled:
+            await asyncio.sleep(max(1.0, self.valves.model_health_push_interval))
+            self.health.window = self.valves.model_health_window
+            models = self.health.summary()
+            if not models or self.breaker.state == CircuitBreaker.OPEN:
+                continue
+            try:
+                client = await get_http_client(
+                    self.valves.http2, self.valves.max_connections
+                )
+                await client.post(
+                    f"{self.valves.API_ENDPOINT}/api/v1/models/health",
+                    headers={"Authorization": f"Bearer {self.valves.API_KEY}"},
+                    json={
+                        "instance": self.metrics.instance,
+                        "window": self.health.window,
+                        "models": models,
+                    },
+                    timeout=httpx.Timeout(
+                        self.valves.read_timeout, connect=self.valves.connect_timeout
+                    ),
+                )
+            except Exception as e:
+                print(f"OpenWebUI Monitor: 推送模型健康统计失败: {e}")
+
+    def _add_rollup(self, body: dict, __user__: dict, result: dict):
+        """累加一次成功计费的使用量；服务端判定为重复的消息不计入"""
+        if not self.valves.usage_rollups or result.get("duplicate"):
+            return
+        self.rollups.add(
+            __user__.get("id"),
+            __user__.get("name"),
+            body.get("model"),
+            result.get("inputTokens"),
+            result.get("outputTokens"),
+            result.get("totalCost"),
+        )
+        self._ensure_rollup_flusher()
+
+    def _ensure_rollup_flusher(self):
+        if self.valves.usage_rollups and (
+            self._rollup_flusher is None or self._rollup_flusher.done()
+        ):
+            self._rollup_flusher = asyncio.create_task(self._flush_rollups())
+
+    async def _flush_rollups(self):
+        """定期上报累加的使用量，关闭后退出；熔断器打开或上报失败时保留批次稍后重试"""
+        while self.valves.usage_rollups:
+            await asyncio.sleep(max(1.0, self.valves.rollup_flush_interval))
+            batch = self.rollups.next_batch()
+            if batch is None or self.breaker.state == CircuitBreaker.OPEN:
+                continue
+            try:
+                response = await self._post("/api/v1/rollups", batch)
+                response.raise_for_status()
+                self.rollups.ack()
+            except Exception as e:
+                print(f"OpenWebUI Monitor: 上报使用量汇总失败: {e}")
+
+    def _record_health(self, body: dict, context: dict, payload: dict):
+        """记录本次请求的结果：带 error 的回复算失败，否则记录完成耗时和解码速度"""
+        if not self.valves.model_health_enabled or context.get("health_recorded"):
+            return
+        model = body.get("model")
+        messages = body.get("messages", [])
+        if messages and messages[-1].get("error"):
+            self.health.record(model, False)
+            return
+
+        latency = None
+        if context.get("start_time"):
+            finished_at = context.get("last_token_at") or time.monotonic()
+            latency = finished_at - context["start_time"]
+        # 输出 token 数未知时按流式块数近似
+        output_tokens = (
+            (payload.get("usage") or {}).get("completion_tokens")
+            or (payload["messages"][-1].get("tokens") if payload["messages"] else None)
+            or context.get("chunks")
+            or 0
+        )
+        self.health.record(
+            model,
+            True,
+            latency,
+            decode_tokens_per_sec(payload.get("timing"), output_tokens),
+        )
+
+    async def _get(
+        self, path: str, params: Optional[dict] = None, headers: Optional[dict] = None
+    ) -> httpx.Response:
+        if not self.breaker.allow():
+            raise MonitorUnavailableError(path)
+
+        client = await get_http_client(self.valves.http2, self.valves.max_connections)
+        try:
+            response = await client.get(
+                f"{self.valves.API_ENDPOINT}{path}",
+                params=params,
+                headers={"Authorization": f"Bearer {self.valves.API_KEY}", **(headers or {})},
+                timeout=httpx.Timeout(
+                    self.valves.read_timeout, connect=self.valves.connect_timeout
+                ),
+            )
+        except httpx.TransportError:
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _ensure_price_refresh(self):
+        if self._price_refresh is None or self._price_refresh.done():
+            self._price_refresh = asyncio.create_task(self._refresh_prices())
+
+    async def _refresh_prices(self):
+        """后台拉取模型价格，不占用 inlet 的请求路径；失败时保留旧价格，30 秒后重试"""
+        try:
+            params, headers = self.prices.request_headers()
+            response = await self._get("/api/v1/models/price", params, headers)
+            if response.status_code == 304:
+                self.prices.not_modified()
+                return
+            response.raise_for_status()
+            self.prices.load(response.json(), response.headers.get("etag"))
+        except Exception as e:
+            self.prices.fetched_at = time.monotonic() - max(0, self.prices.ttl - 30)
+            print(f"OpenWebUI Monitor: 获取模型价格失败: {e}")
+
+    async def _estimate_cost(self, body: dict, tokens: Optional[tuple] = None) -> float:
+        """按本地 token 计数和缓存的价格预估本次请求的最高费用；价格尚未加载时返回 0"""
+        self.prices.ttl = self.valves.price_refresh_interval
+        if self.prices.stale():
+            self._ensure_price_refresh()
+
+        model = body.get("model")
+        price = self.prices.get(model)
+        if price is None:
+            return 0.0
+
+        if price[2] >= 0:
+            return PriceCache.cost(price, 0, self._output_budget(body))
+
+        input_tokens, output_tokens = tokens or await self._estimate_tokens(body)
+        return PriceCache.cost(price, input_tokens, output_tokens)
+
+    def _output_budget(self, body: dict) -> int:
+        return (
+            body.get("max_tokens")
+            or body.get("max_completion_tokens")
+            or self.valves.budget_output_tokens
+        )
+
+    async def _estimate_tokens(self, body: dict) -> tuple:
+        """本地计算输入 token 数，输出按 max_tokens（未设置时按 budget_output_tokens）计"""
+        model = body.get("model")
+        self.tokens.default_encoding = self.valves.tokenizer_encoding
+        self.tokens.max_entries = self.valves.token_cache_size
+        count_locally = await self.tokens.prepare(model)
+        input_tokens = 0
+        for message in body.get("messages", []):
+            text = message_text(message.get("content"))
+            if count_locally:
+                input_tokens += self.tokens.count(model, text, content_hash(text))
+            else:
+                # 没有分词器时按约 4 个字符一个 token 粗略估算
+                input_tokens += len(text) // 4
+        return input_tokens, self._output_budget(body)
+
+    def _role_limits(self, role: Optional[str]) -> dict:
+        """每个用户的配额，按角色覆盖；覆盖配置无效时打印警告并忽略"""
+        raw = self.valves.rate_limit_role_overrides
+        if raw != self._role_overrides_raw:
+            self._role_overrides_raw = raw
+            try:
+                overrides = json.loads(raw) if raw.strip() else {}
+                if not isinstance(overrides, dict):
+                    raise ValueError("需要 JSON 对象")
+            except ValueError as e:
+                print(f"OpenWebUI Monitor: rate_limit_role_overrides 无效，已忽略: {e}")
+                overrides = {}
+            self._role_overrides = self._parse_role_overrides(overrides)
+
+        limits = {
+            "user_requests_per_minute": self.valves.user_requests_per_minute,
+            "user_tokens_per_minute": self.valves.user_tokens_per_minute,
+        }
+        limits.update(self._role_overrides.get(role, {}))
+        return limits
+
+    @staticmethod
+    def _parse_role_overrides(overrides: dict) -> dict:
+        """把每个角色的配额转换为数字；不是非负数的配额打印警告并忽略"""
+        parsed = {}
+        for role, override in overrides.items():
+            if not isinstance(override, dict):
+                print(f"OpenWebUI Monitor: rate_limit_role_overrides 中 {role} 的配置不是 JSON 对象，已忽略")
+                continue
+            parsed[role] = {}
+            for key, value in override.items():
+                if key not in ("user_requests_per_minute", "user_tokens_per_minute"):
+                    continue
+                try:
+                    if isinstance(value, bool):
+                        raise ValueError
+                    number = float(value)
+                    if not math.isfinite(number) or number < 0:
+                        raise ValueError
+                except (TypeError, ValueError):
+                    print(f"OpenWebUI Monitor: rate_limit_role_overrides 中 {role}.{key} 的值 {value!r} 无效，已忽略")
+                    continue
+                parsed[role][key] = number
+        return parsed
+
+    async def _check_rate_limit(self, body: dict, __user__: dict) -> Optional[tuple]:
+        """本地令牌桶限流，无需请求监控服务；超限时抛出提示重试时间的异常
+
+        配置了 token 配额时返回预估的 (输入, 输出) token 数，供预估费用复用。
+        """
+        valves = self.valves
+        if not valves.rate_limit_enabled:
+            return None
+        limits = self._role_limits(__user__.get("role"))
+        user_id = __user__.get("id")
+        model = body.get("model")
+
+        tokens = None
+        if limits["user_tokens_per_minute"] > 0 or valves.model_tokens_per_minute > 0:
+            tokens = await self._estimate_tokens(body)
+        total = sum(tokens) if tokens else 0
+
+        rejected = self.limiter.acquire(
+            [
+                (("user_requests", user_id), limits["user_requests_per_minute"], 1),
+                (("user_tokens", user_id), limits["user_tokens_per_minute"], total),
+                (("model_requests", model), valves.model_requests_per_minute, 1),
+                (("model_tokens", model), valves.model_tokens_per_minute, total),
+            ]
+        )
+        if rejected is not None:
+            (kind, _), per_minute, wait = rejected
+            limit = f"{per_minute:g} {'RPM' if kind.endswith('requests') else 'TPM'}"
+            key = "rate_limited_model" if kind.startswith("model") else "rate_limited_user"
+            raise Exception(self.get_text(key, model=model, limit=limit, wait=math.ceil(wait)))
+        return tokens
+
+    def _claim_message(self, message_id: Optional[str]) -> bool:
+        """本 worker 已计费过这条消息时返回 False，outlet 直接跳过"""
+        if not message_id or not self.valves.dedupe_outlet:
+            return True
+        self.seen.window = self.valves.dedupe_window
+        self.seen.configure(
+            self.valves.dedupe_capacity, self.valves.dedupe_false_positive_rate
+        )
+        return self.seen.claim(message_id)
+
+    async def _reserve(
+        self, context: dict, user_id: Optional[str], key: str, amount: float
+    ):
+        context["reservation"] = (user_id, key, amount)
+        if amount > 0:
+            # 预留只需覆盖一次生成，不跟随上下文的 TTL，避免未调用 outlet 的请求长时间占用余额
+            ttl = self.valves.max_generation_time + self.valves.read_timeout
+            await asyncio.gather(
+                self.balances.reserve(user_id, key, amount, ttl),
+                self.contexts.share(key, context),
+            )
+
+    async def _build_outlet_payload(self, body: dict, __user__: dict) -> dict:
+        """构建精简的 outlet 请求，只发送计费需要的字段而不是整段对话"""
+        model = body.get("model")
+        messages = body.get("messages", [])
+        last_message = messages[-1] if messages else {}
+        info = last_message.get("info") or last_message.get("usage") or {}
+        usage = None
+        if info.get("prompt_tokens") and info.get("completion_tokens"):
+            usage = {
+                "prompt_tokens": info["prompt_tokens"],
+                "completion_tokens": info["completion_tokens"],
+            }
+
+        count_locally = False
+        if usage is None and self.valves.local_token_count:
+            self.tokens.default_encoding = self.valves.tokenizer_encoding
+            self.tokens.max_entries = self.valves.token_cache_size
+            count_locally = await self.tokens.prepare(model)
+
+        compact_messages = []
+        for message in messages:
+            text = message_text(message.get("content"))
+            digest = content_hash(text)
+            entry = {"role": message.get("role"), "hash": digest}
+            # 没有 usage 时需要 token 数：优先本地计算，否则交给服务端按内容计算
+            if count_locally:
+                entry["tokens"] = self.tokens.count(model, text, digest)
+            elif usage is None:
+                entry["content"] = text
+            compact_messages.append(entry)
+
+        payload = {
+            "version": 2,
+            "model": body.get("model"),
+            "user": {"id": __user__.get("id"), "name": __user__.get("name")},
+            "usage": usage,
+            "messages": compact_messages,
+        }
+
+        # token 数已知且有缓存的价格时预先算好费用，服务端只需校验
+        price = self.prices.get(model)
+        counts = [message.get("tokens") for message in compact_messages]
+        if price is not None and usage is not None:
+            payload["cost"] = PriceCache.cost(
+                price, usage["prompt_tokens"], usage["completion_tokens"]
+            )
+        elif price is not None and counts and None not in counts:
+            payload["cost"] = PriceCache.cost(price, sum(counts[:-1]), counts[-1])
+        return payload
+
+    def _get_spool(self) -> OutletSpool:
+        if self._spool is None or self._spool.path != self.valves.spool_path:
+            self._spool = OutletSpool(self.valves.spool_path)
+        return self._spool
 
-    def inlet(
-        self, body: dict, user: Optional[dict] = None, __user__: dict = {}
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_spool())
+
+    async def _enqueue_outlet(self, payload: dict) -> bool:
+        """把 outlet 事件写入本地队列，由后台任务批量发送"""
+        spool = self._get_spool()
+        # 没有消息 ID 时用随机的事件 ID：服务端以它作为幂等键，只对同一事件的重发去重
+        queued = await asyncio.to_thread(
+            spool.append,
+            payload.get("message_id") or uuid.uuid4().hex,
+            self._encode(payload),
+            self.valves.max_spool_events,
+        )
+        if queued:
+            self._ensure_flusher()
+        return queued
+
+    async def _flush_batch(self) -> int:
+        spool = self._get_spool()
+        events = await asyncio.to_thread(spool.peek, self.valves.batch_size)
+        if not events:
+            return 0
+
+        # 队列中存的是已编码的 payload，直接拼接成批量请求体，无需解析再编码
+        content = (
+            b'{"events":['
+            + b",".join(
+                b'{"id":'
+                + self._encode(event_id)
+                + b',"payload":'
+                + (payload if isinstance(payload, bytes) else payload.encode("utf-8"))
+                + b"}"
+                for event_id, payload in events
+            )
+            + b"]}"
+        )
+        response = await self._post("/api/v1/outlet/batch", content)
+        response.raise_for_status()
+
+        acked, failed = [], []
+        for result in response.json().get("results", []):
+            if result.get("success"):
+                acked.append(result["id"])
+                await self.balances.update(result.get("userId"), result["newBalance"])
+                self._add_rollup(
+                    {"model": result.get("modelId")},
+                    {"id": result.get("userId"), "name": result.get("userName")},
+                    result,
+                )
+            else:
+                failed.append(result["id"])
+
+        await asyncio.to_thread(spool.ack, acked)
+        dropped = await asyncio.to_thread(spool.fail, failed)
+        if dropped:
+            print(f"OpenWebUI Monitor: 丢弃多次计费失败的事件 {dropped}")
+        return len(events)
+
+    async def _flush_spool(self):
+        """后台发送队列中的事件；失败时指数退避，队列积压时连续发送"""
+        delay = self.valves.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                while await self._flush_batch() >= self.valves.batch_size:
+                    pass
+                delay = self.valves.flush_interval
+            except Exception as e:
+                print(f"OpenWebUI Monitor: 计费队列发送失败: {e}")
+                delay = min(max(delay, 1) * 2, 60)
+
+    async def inlet(
+        self,
+        body: dict,
+        user: Optional[dict] = None,
+        __user__: dict = {},
+        __metadata__: Optional[dict] = None,
     ) -> dict:
-        self.start_time = time.time()
+        self._ensure_metrics_pusher()
+        self._ensure_health_pusher()
+        self._sync_state_backend()
+        # 限流在本地完成，被拒绝的请求不会创建上下文，也不会请求监控服务
+        tokens = await self._check_rate_limit(body, __user__)
+        self.contexts.ttl = self.valves.context_ttl
+        self.contexts.max_entries = self.valves.max_contexts
+        context = {
+            "start_time": time.monotonic(),
+            "outage": False,
+            "model": body.get("model"),
+        }
+        key = RequestContextStore.make_key(body, __metadata__, __user__)
+        await self.contexts.put(key, context)
+
+        # 预估本次请求的费用并从缓存余额中预留，outlet 按实际费用结算
+        user_id = __user__.get("id")
+        estimate = (
+            await self._estimate_cost(body, tokens) if self.valves.budget_check else 0.0
+        )
+
+        self.balances.ttl = self.valves.balance_cache_ttl
+        if (
+            await self.balances.lookup(
+                user_id, self.valves.balance_safety_margin, estimate
+            )
+            is not None
+        ):
+            await self._reserve(context, user_id, key, estimate)
+            return body
 
         try:
-            post_url = f"{self.valves.API_ENDPOINT}/api/v1/inlet"
-            headers = {"Authorization": f"Bearer {self.valves.API_KEY}"}
-            
-            user_dict = self._prepare_user_dict(__user__)
-            
-            response = requests.post(
-                post_url, headers=headers, json={"user": user_dict, "body": body}
+            # 监控服务只需要用户信息，按用户 ID 复用预先序列化的结果
+            started = time.perf_counter()
+            user_header = self.user_headers.get(__user__, self._encode)
+            self.metrics.observe(
+                "serialize_seconds",
+                time.perf_counter() - started,
+                (("path", "/api/v1/inlet"), ("stage", "user_header")),
             )
 
+            response = await self._post("/api/v1/inlet", b'{"user":' + user_header + b"}")
+
             if response.status_code == 401:
                 return body
 
@@ -103,15 +2526,26 @@ class Filter:
                 error_type = response_data.get("error_type", "UNKNOWN_ERROR")
                 raise Exception(self.get_text("request_failed", error_type=error_type, error_msg=error_msg))
 
-            self.outage = response_data.get("balance", 0) <= 0
-            if self.outage:
+            await self.balances.update(user_id, response_data.get("balance", 0))
+            context["outage"] = response_data.get("balance", 0) <= 0
+            if context["outage"]:
                 raise Exception(self.get_text("insufficient_balance", balance=response_data['balance']))
 
+            available = response_data["balance"] - await self.balances.reserved(user_id)
+            if estimate > available:
+                context["outage"] = True
+                raise Exception(self.get_text("insufficient_budget", estimate=estimate, balance=available))
+            await self._reserve(context, user_id, key, estimate)
+
             return body
 
-        except requests.exceptions.RequestException as e:
+        except (MonitorUnavailableError, httpx.TransportError) as e:
+            if self.valves.fail_open:
+                return body
+            raise Exception(self.get_text("monitor_unavailable"))
+        except httpx.HTTPError as e:
             if (
-                isinstance(e, requests.exceptions.HTTPError)
+                isinstance(e, httpx.HTTPStatusError)
                 and e.response.status_code == 401
             ):
                 return body
@@ -119,28 +2553,143 @@ class Filter:
         except Exception as e:
             raise Exception(f"处理请求时发生错误: {str(e)}")
 
+    @staticmethod
+    def _timing_values(
+        values: dict, context: dict, timing: Optional[dict], output_tokens: Optional[int]
+    ):
+        """补充耗时和速度字段：有流式计时数据时使用首字延迟和纯解码速度，否则按总耗时估算"""
+        if not context.get("start_time"):
+            return
+        elapsed_time = time.monotonic() - context["start_time"]
+        values["time"] = elapsed_time
+        if not output_tokens or elapsed_time <= 0:
+            return
+
+        tokens_per_sec = decode_tokens_per_sec(timing, output_tokens)
+        if tokens_per_sec is None:
+            values["tokens_per_sec"] = output_tokens / elapsed_time
+        else:
+            values["ttft"] = timing["ttft_ms"] / 1000
+            values["tokens_per_sec"] = tokens_per_sec
+
+    async def _debit_queued(
+        self, payload: dict, context: dict, user_id: Optional[str]
+    ):
+        """写后计费的实际费用要等批量结果才知道，先按本地算出的费用（或预留金额）从缓存余额中扣除"""
+        cost = payload.get("cost")
+        if cost is None:
+            cost = (context.get("reservation") or (None, None, 0.0))[2]
+        await self.balances.debit(user_id, cost)
+
+    async def _emit_queued_status(
+        self,
+        payload: dict,
+        context: dict,
+        __user__: dict,
+        __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+    ):
+        """写后模式下费用和余额要等批量计费完成才知道，只显示本地已知的统计"""
+        if not __event_emitter__:
+            return
+
+        values = {"queued": True}
+        counts = [message.get("tokens") for message in payload["messages"]]
+        if payload["usage"]:
+            values["input"] = payload["usage"]["prompt_tokens"]
+            values["output"] = payload["usage"]["completion_tokens"]
+        elif counts and None not in counts:
+            values["input"], values["output"] = sum(counts[:-1]), counts[-1]
+        self._timing_values(values, context, payload["timing"], values.get("output"))
+
+        await __event_emitter__(
+            {
+                "type": "status",
+                "data": {
+                    "description": self._status_renderer(__user__).render(values),
+                    "done": True,
+                },
+            }
+        )
+
+    def _spawn(self, coro: Awaitable):
+        """在同步钩子中执行异步操作：有事件循环时作为后台任务，否则直接运行"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(coro)
+            return
+        task = loop.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        """记录流式输出的首 token 和最后一个 token 的时间，用于计算真实的解码速度"""
+        if not __metadata__:
+            return event
+        key = RequestContextStore.make_key({}, __metadata__, None)
+        context = self.contexts.get(key)
+        if context is None:
+            return event
+
+        # 上游报错时 outlet 通常不会被调用，在这里记为失败并释放预留的费用
+        if event.get("error") and not context.get("health_recorded"):
+            context["health_recorded"] = True
+            if self.valves.model_health_enabled:
+                self.health.record(context.get("model"), False)
+            if context.get("reservation"):
+                self._spawn(self.balances.release(*context["reservation"][:2]))
+            return event
+
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            if delta.get("content") or delta.get("reasoning_content"):
+                now = time.monotonic()
+                context.setdefault("first_token_at", now)
+                context["last_token_at"] = now
+                context["chunks"] = context.get("chunks", 0) + 1
+                self.contexts.touch(key, context)
+                break
+        return event
+
     async def outlet(
         self,
         body: dict,
         user: Optional[dict] = None,
         __user__: dict = {},
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        __metadata__: Optional[dict] = None,
     ) -> dict:
-        if self.outage:
+        self._ensure_metrics_pusher()
+        self._ensure_health_pusher()
+        self._sync_state_backend()
+        context = await self.contexts.pop(
+            RequestContextStore.make_key(body, __metadata__, __user__)
+        ) or {}
+        if context.get("reservation"):
+            await self.balances.release(*context["reservation"][:2])
+        if context.get("outage"):
+            return body
+
+        # assistant 消息 ID 作为幂等键：本地已计费的直接跳过，服务端按 message_id 去重
+        message_id = outlet_message_id(body)
+        if not self._claim_message(message_id):
             return body
 
         try:
-            post_url = f"{self.valves.API_ENDPOINT}/api/v1/outlet"
-            headers = {"Authorization": f"Bearer {self.valves.API_KEY}"}
-            
-            user_dict = self._prepare_user_dict(__user__)
-            
-            request_data = {
-                "user": user_dict,
-                "body": body,
-            }
+            payload = await self._build_outlet_payload(body, __user__)
+            payload["timing"] = stream_timing(context)
+            self._record_health(body, context, payload)
+            if message_id:
+                payload["message_id"] = message_id
+
+            if self.valves.write_behind:
+                if await self._enqueue_outlet(payload):
+                    self.seen.confirm(message_id)
+                    await self._debit_queued(payload, context, __user__.get("id"))
+                    await self._emit_queued_status(payload, context, __user__, __event_emitter__)
+                    return body
 
-            response = requests.post(post_url, headers=headers, json=request_data)
+            response = await self._post("/api/v1/outlet", payload)
 
             if response.status_code == 401:
                 if __event_emitter__:
@@ -162,29 +2711,18 @@ class Filter:
                 error_msg = result.get("error", "未知错误")
                 error_type = result.get("error_type", "UNKNOWN_ERROR")
                 raise Exception(f"请求失败: [{error_type}] {error_msg}")
+            self.seen.confirm(message_id)
+            self._add_rollup(body, __user__, result)
 
-            input_tokens = result["inputTokens"]
-            output_tokens = result["outputTokens"]
-            total_cost = result["totalCost"]
-            new_balance = result["newBalance"]
-
-            stats_array = []
-
-            if self.valves.show_cost:
-                stats_array.append(self.get_text("cost", cost=total_cost))
-            if self.valves.show_balance:
-                stats_array.append(self.get_text("balance", balance=new_balance))
-            if self.valves.show_tokens:
-                stats_array.append(self.get_text("tokens", input=input_tokens, output=output_tokens))
-
-            if self.start_time:
-                elapsed_time = time.time() - self.start_time
-                stats_array.append(self.get_text("time_spent", time=elapsed_time))
-                
-                if self.valves.show_tokens_per_sec:
-                    stats_array.append(self.get_text("tokens_per_sec", tokens_per_sec=output_tokens/elapsed_time))
-
-            stats = " | ".join(stat for stat in stats_array)
+            values = {
+                "cost": result["totalCost"],
+                "balance": result["newBalance"],
+                "input": result["inputTokens"],
+                "output": result["outputTokens"],
+            }
+            await self.balances.update(__user__.get("id"), values["balance"])
+            self._timing_values(values, context, payload["timing"], values["output"])
+            stats = self._status_renderer(__user__).render(values)
 
             if __event_emitter__:
                 await __event_emitter__(
@@ -199,9 +2737,34 @@ class Filter:
 
             return body
 
-        except requests.exceptions.RequestException as e:
+        except (MonitorUnavailableError, httpx.TransportError) as e:
+            # 监控服务不可用时把计费写入本地队列，恢复后由后台任务补发
+            try:
+                queued = await self._enqueue_outlet(payload)
+            except Exception:
+                queued = False
+            if queued:
+                self.seen.confirm(message_id)
+                await self._debit_queued(payload, context, __user__.get("id"))
+                await self._emit_queued_status(payload, context, __user__, __event_emitter__)
+                return body
+
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": self.get_text("monitor_unavailable"),
+                            "done": True,
+                        },
+                    }
+                )
+            if self.valves.fail_open:
+                return body
+            raise Exception(self.get_text("monitor_unavailable"))
+        except httpx.HTTPError as e:
             if (
-                isinstance(e, requests.exceptions.HTTPError)
+                isinstance(e, httpx.HTTPStatusError)
                 and e.response.status_code == 401
             ):
                 if __event_emitter__:
@@ -228,3 +2791,5 @@ class Filter:
                     }
                 )
             raise Exception(f"处理请求时发生错误: {str(e)}")
+        finally:
+            self.seen.release(message_id)